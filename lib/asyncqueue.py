@@ -0,0 +1,115 @@
+"""FoundationDB Asynchronous Queues.
+
+Provides AsyncQueue() and AsyncPriorityQueue() classes, which wrap a Queue or
+PriorityQueue for use from an asyncio event loop.
+
+Each operation returns an asyncio future, so it can be awaited with
+"await q.pop()" under asyncio, or "yield From(q.pop())" under trollius, the
+asyncio backport for Python 2. The operation itself runs the wrapped queue's
+blocking calls in the loop's executor, so the event loop keeps serving other
+tasks while it waits on the database. The wrapped queue is not modified, so
+it can still be used directly or by other wrappers.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import fdb
+
+import priorityqueue
+import queue
+
+fdb.api_version(200)
+
+##############
+# AsyncQueue #
+##############
+
+class AsyncQueue(object):
+    """Runs the operations of a Queue in an asyncio executor."""
+
+    def __init__(self, db, queue, loop=None, executor=None):
+        """
+        Wrap queue for use from loop, or the current event loop if loop is
+        None. Operations run in executor, or the loop's default executor if
+        executor is None.
+        """
+        self.db = db
+        self.queue = queue
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, self.db, *args)
+
+    def push(self, value, deliverAt=None):
+        """Push a single item onto the queue."""
+        return self._run(self.queue.push, value, deliverAt)
+
+    def pop(self):
+        """Pop the next item from the queue."""
+        return self._run(self.queue.pop)
+
+    def peek(self):
+        """Get the value of the next item in the queue without popping it."""
+        return self._run(self.queue.peek)
+
+    def empty(self):
+        """Test whether the queue is empty."""
+        return self._run(self.queue.empty)
+
+######################
+# AsyncPriorityQueue #
+######################
+
+class AsyncPriorityQueue(object):
+    '''Runs the operations of a PriorityQueue in an asyncio executor.'''
+
+    def __init__(self, db, pq, loop=None, executor=None):
+        '''Wrap pq for use from loop, as for AsyncQueue.'''
+        self.db = db
+        self.pq = pq
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, self.db, *args)
+
+    def push(self, item, priority, random_ID=None):
+        '''Push a single item onto the queue.'''
+        if random_ID is None:
+            random_ID = priorityqueue._random_ID()
+        return self._run(self.pq.push, item, priority, random_ID)
+
+    def pop(self, max=False):
+        '''Pop the next item from the queue.'''
+        return self._run(self.pq.pop, max)
+
+    def peek(self, max=False):
+        '''Get the next item in the queue without popping it.'''
+        return self._run(self.pq.peek, max)
+
+    def isempty(self):
+        '''Test whether the queue is empty.'''
+        return self._run(self.pq.isempty)
+
+##################
+# Internal tests #
+##################
+
+# caution: modifies the database!
+def async_queue_example(db, consumers=100):
+    loop = asyncio.get_event_loop()
+    q = AsyncQueue(db, queue.Queue(fdb.directory.create_or_open(db, ('tests','queue')), True), loop)
+    q.queue.clear(db)
+
+    loop.run_until_complete(asyncio.gather(*[q.push(i) for i in range(consumers)]))
+    popped = loop.run_until_complete(asyncio.gather(*[q.pop() for i in range(consumers)]))
+
+    print 'Popped %d items' % len([v for v in popped if v is not None])
+
+if __name__ == '__main__':
+    db = fdb.open()
+    async_queue_example(db)
@@ -15,12 +15,45 @@ In the low-contention version, no attempt is made to avoid transaction conflicts
 during pop operations. This version performs well with a small number of clients
 but will not scale well as the number of clients grows.
 
+Several items can be popped or peeked at once with a single range read. In the
+high-contention version, a pop request for several items is fulfilled with a
+whole batch of items at once. Pop requests record which end of the queue they
+pop from, and a batch fulfills minimum and maximum requests from their own ends.
+
+The inverse index on items records the random ID of each pushed item, so an
+item can be removed or moved to a new priority with direct key access, without
+scanning the items at its priority.
+
+A queue can be configured with weighted priority bands, each a range of
+priorities. pop_fair() then serves the bands in proportion to their weights,
+so that low-priority bands are not starved during bursts of urgent items. Each
+pop reads only the front of the band it serves.
+
+Items can be pushed with a not-before time, which keeps them out of the queue
+until they are due. Due items are moved into the queue inside the transaction
+of the next pop, lease or peek. Items can also be leased instead of popped; a leased item
+is removed for good when it is acknowledged, and is returned to the queue if
+its lease expires first. Due items and expired leases are found with a single
+range read over an index ordered by time.
+
+The number of items at each priority and in total is maintained with atomic
+adds, so the size of the queue can be read without scanning the items. A
+queue written before the counts were maintained should be recounted once with
+recount().
+
 The contract for the order of results of pop operations is best effort. Perfect
 order is achieved in the low-contention version but not in the high-contention
 version.
+
+Large items are stored out of line in chunks, and only a small reference to
+them moves through the queue. The inverse index of large items is keyed by a
+digest of the item instead of the item itself.
 '''
 
+import hashlib
 import os
+import struct
+import threading
 import time
 
 import fdb
@@ -36,49 +69,269 @@ fdb.api_version(200)
 class PriorityQueue(object):
     # Public methods
 
-    def __init__(self, subspace, high=True):
+    def __init__(self, subspace, high=True, bands=None, sleep=time.sleep):
+        '''Create a priority queue in subspace.
+
+        bands optionally lists (lowest priority, weight) pairs for pop_fair().
+        Each band holds the priorities from its lowest priority up to the next
+        band's; the first band also holds all lower priorities, and the last
+        band all higher ones.
+
+        sleep is used to wait between polls for a pop request, and can be a
+        cooperative sleep such as gevent.sleep.'''
         self._high = high # boolean determining contention mode
         self.subspace = subspace # root subspace
         self._item = self.subspace['I'] # ordered items
-        self._member = self.subspace['M'] # inverse index on items
+        self._member = self.subspace['M'] # (item, priority, count) = random ID
+        self._count = self.subspace['C'] # (priority) = number of items
+        self._total = self.subspace['N'] # total number of items
         # subspaces for high-contention mode
         self._pop_request = self.subspace['P'] # pending pop requests
         self._requested_item = self.subspace['R'] # items that fulfill requests
+        # subspaces for scheduling and leases
+        self._scheduled = self.subspace['W'] # (due, priority, random ID) = item
+        self._leased = self.subspace['E'] # (expiry, lease ID) = (key, item)
+        self._lease = self.subspace['X'] # (lease ID) = (expiry,)
+        # subspaces for large items
+        self._payload = self.subspace['D'] # (payload ID, offset) = chunk
+        self._large_member = self.subspace['L'] # inverse index by digest
+        self._spill_threshold = 1000
+        self._chunk_size = 10000
+        # used to wait between polls for a pop request
+        self._sleep = sleep
+        # weighted-fair bands as (lowest priority, highest priority, weight),
+        # where None is unbounded, and their smooth weighted round-robin cursors
+        self._bands = []
+        if bands:
+            bands = sorted(bands)
+            bounds = [None] + [b[0] for b in bands[1:]] + [None]
+            self._bands = [(bounds[i], bounds[i + 1], bands[i][1])
+                           for i in range(len(bands))]
+        self._band_cursors = [0] * len(self._bands)
+        self._band_lock = threading.Lock()
+        # pops by this client since it last compacted the counts
+        self._compact_interval = 1000
+        self._pops_since_compact = 0
 
     @fdb.transactional
-    def push(self, tr, item, priority, random_ID):
-        '''Push a single item onto the queue.'''
+    def push(self, tr, item, priority, random_ID, not_before=None):
+        '''Push a single item onto the queue.
+
+        If not_before (a time as returned by time.time()) is in the future, the
+        item stays out of the queue until then.'''
+        if not_before is not None and _to_ms(not_before) > _now_ms():
+            key = self._scheduled[_to_ms(not_before)][priority][random_ID]
+            tr.add_read_conflict_key(key)
+            tr[key] = self._store(tr, item)
+            return
         if self._check_at_priority(tr, item, priority):
             return
         count = self._get_next_count(tr.snapshot, self._item[priority])
-        self._push_at(tr, self._encode(item), count, priority, random_ID)
+        self._push_at(tr, item, count, priority, random_ID)
 
     def pop(self, db, max=False):
         '''Pop the next item from the queue.
 
         Cannot be composed with other functions in a single transaction.'''
+        self._compact_periodically(db)
         if self._high:
-            result = self._pop_high(db, max)
+            results = self._pop_high(db, max)
+            result = results[0] if results else None
         else:
             result = self._pop_low(db, max)
-        if result is None:
-            return None
-        return self._decode(result)
+        return result
+
+    def pop_fair(self, db):
+        '''Pop the next item from the band whose turn it is.
+
+        Bands are served in proportion to their weights. If the band whose turn
+        it is has no items, the next band in turn is tried instead.
+
+        Cannot be composed with other functions in a single transaction.'''
+        if not self._bands:
+            raise Exception('pop_fair requires a queue configured with bands')
+        self._compact_periodically(db)
+        for lo, hi in self._band_order():
+            if self._high:
+                results = self._pop_high(db, False, 1, lo, hi)
+                result = results[0] if results else None
+            else:
+                result = self._pop_low_band(db, lo, hi)
+            if result is not None:
+                return result
+        return None
+
+    def pop_many(self, db, k, max=False):
+        '''Pop up to k items from the queue, in order.
+
+        Cannot be composed with other functions in a single transaction.'''
+        self._compact_periodically(db)
+        if self._high:
+            return self._pop_high(db, max, k)
+        return self._pop_low_many(db, k, max)
+
+    @fdb.transactional
+    def lease(self, tr, k=1, timeout=30, max=False):
+        '''Lease up to k items from the queue for timeout seconds.
+
+        Returns a list of (lease ID, item) pairs. A leased item is out of the
+        queue until it is acknowledged with ack(), or its lease expires and it
+        is returned to the queue by reclaim_expired().'''
+        self.promote_due(tr)
+        expiry = _now_ms() + int(timeout * 1000)
+        leased = []
+        removed = {}
+        for key, value in self._get_first_items(tr, k, max):
+            lease_ID = _random_ID()
+            del tr[key]
+            priority, count, _ = self._item.unpack(key)
+            del tr[self._stored_member_subspace(value)[priority][count]]
+            removed[priority] = removed.get(priority, 0) - 1
+            tr[self._leased[expiry][lease_ID]] = fdb.tuple.pack((key, value))
+            tr[self._lease[lease_ID]] = fdb.tuple.pack((expiry,))
+            leased.append((lease_ID, self._load(tr, value)))
+        self._add_counts(tr, removed)
+        return leased
+
+    @fdb.transactional
+    def ack(self, tr, lease_IDs):
+        '''Acknowledge leased items, removing them for good.
+
+        Returns the number of leases that were still held.'''
+        expiries = [(lease_ID, tr[self._lease[lease_ID]]) for lease_ID in lease_IDs]
+        leases = [(lease_ID, fdb.tuple.unpack(expiry)[0])
+                  for lease_ID, expiry in expiries if expiry.present()]
+        values = [tr[self._leased[expiry][lease_ID]] for lease_ID, expiry in leases]
+        for (lease_ID, expiry), value in zip(leases, values):
+            self._delete_payload(tr, fdb.tuple.unpack(str(value))[1])
+            del tr[self._leased[expiry][lease_ID]]
+            del tr[self._lease[lease_ID]]
+        return len(leases)
+
+    @fdb.transactional
+    def reclaim_expired(self, tr, limit=100):
+        '''Return up to limit items whose leases have expired to the queue.
+
+        Items go back to their original position. Returns the number of items
+        returned.'''
+        r = self._leased.range()
+        due = self._leased.range((_now_ms(),)).stop
+        reclaimed = 0
+        for leased_key, leased_value in tr.get_range(r.start, due, limit=limit):
+            lease_ID = self._leased.unpack(leased_key)[1]
+            key, value = fdb.tuple.unpack(leased_value)
+            priority, count, random_ID = self._item.unpack(key)
+            tr[key] = value
+            tr[self._stored_member_subspace(value)[priority][count]] = random_ID
+            self._add_count(tr, priority, 1)
+            del tr[leased_key]
+            del tr[self._lease[lease_ID]]
+            reclaimed += 1
+        return reclaimed
+
+    @fdb.transactional
+    def promote_due(self, tr, limit=100):
+        '''Move up to limit scheduled items that are due into the queue.
+
+        Returns the number of items moved. Only due items are read.'''
+        r = self._scheduled.range()
+        end = self._scheduled.range((_now_ms(),)).stop
+        # Checked at snapshot isolation first, so that pops while nothing is
+        # due don't conflict with each other or with scheduled pushes.
+        if not list(tr.snapshot.get_range(r.start, end, limit=1)):
+            return 0
+        due = list(tr.get_range(r.start, end, limit=limit))
+        for key, value in due:
+            _, priority, random_ID = self._scheduled.unpack(key)
+            member_subspace = self._stored_member_subspace(value)
+            if self._has_member(tr, member_subspace, priority):
+                self._delete_payload(tr, value)
+                continue
+            count = self._get_next_count(tr.snapshot, self._item[priority])
+            self._push_stored(tr, value, count, priority, random_ID)
+        if due:
+            del tr[r.start:due[-1].key + '\x00']
+        return len(due)
 
     @fdb.transactional
     def peek(self, tr, max=False):
-        '''Get the next item in the queue without popping it.'''
+        '''Get the next item in the queue without popping it.
+
+        Scheduled items that are due are first moved into the queue, as by
+        pop().'''
+        self.promote_due(tr)
         first_item = self._get_first_item(tr, max)
         if first_item is None:
             return None
         else:
-            return self._decode(first_item.value)
+            return self._load(tr, first_item.value)
+
+    @fdb.transactional
+    def peek_many(self, tr, k, max=False):
+        '''Get up to k items from the front of the queue without popping them.'''
+        self.promote_due(tr)
+        return [self._load(tr, kv.value) for kv in self._get_first_items(tr, k, max)]
 
     @fdb.transactional
     def isempty(self, tr):
-        '''Test whether the queue is empty.'''
+        '''Test whether the queue is empty, once scheduled items that are due
+        have been moved into it.'''
+        self.promote_due(tr)
         return self._get_first_item(tr) is None
 
+    @fdb.transactional
+    def size(self, tr):
+        '''Get the number of items in the queue.'''
+        return self._decode_count(tr[self._total.key()])
+
+    @fdb.transactional
+    def size_at(self, tr, priority):
+        '''Get the number of items in the queue with the given priority.'''
+        return self._decode_count(tr[self._count[priority]])
+
+    @fdb.transactional
+    def histogram(self, tr):
+        '''Get a dictionary mapping each priority in the queue to its number of items.'''
+        histogram = {}
+        for k, v in tr[self._count.range()]:
+            count = self._decode_count(v)
+            if count:
+                histogram[self._count.unpack(k)[0]] = count
+        return histogram
+
+    @fdb.transactional
+    def compact_counts(self, tr, limit=1000):
+        '''Clear up to limit per-priority counts that have fallen to zero.
+
+        A decrement clears a count it takes to zero, but concurrent decrements
+        that each saw a larger count leave a zero behind. Pops call this every
+        so often. Returns the number of counts cleared.'''
+        r = self._count.range()
+        cleared = 0
+        for key, value in tr.snapshot.get_range(r.start, r.stop, limit=limit):
+            if self._decode_count(value) != 0:
+                continue
+            # Conflicts with any change to the count since it was read
+            tr.add_read_conflict_key(key)
+            del tr[key]
+            cleared += 1
+        return cleared
+
+    @fdb.transactional
+    def recount(self, tr):
+        '''Recompute the item counts from the items in the queue.
+
+        Every item is read in a single transaction, so the queue must be small
+        enough to be read within the transaction limits.'''
+        counts = {}
+        for key, _ in tr[self._item.range()]:
+            priority = self._item.unpack(key)[0]
+            counts[priority] = counts.get(priority, 0) + 1
+        del tr[self._count.range()]
+        for priority, count in counts.items():
+            tr[self._count[priority].key()] = struct.pack('<q', count)
+        tr[self._total.key()] = struct.pack('<q', sum(counts.values()))
+
     @fdb.transactional
     def clear(self, tr):
         '''Remove all items from the queue.'''
@@ -87,14 +340,47 @@ class PriorityQueue(object):
     @fdb.transactional
     def remove(self, tr, item):
         '''Remove item from arbitrary position in the queue.'''
-        for member in tr[self._member[item].range()]:
-            priority, count = self._member[item].unpack(member.key)
-            for item_key, value in tr[self._item[priority][count].range()]:
-                random_id = self._item[priority][count].unpack(item_key)[0]
-                i = self._decode(value)
-                if i == item:
-                    del tr[self._item[priority][count][random_id]]
-            del tr[self._member[item][priority][count]]
+        member_subspace = self._member_subspace(item)
+        spilled = member_subspace.key().startswith(self._large_member.key())
+        removed = {}
+        for priority, count, item_key in self._get_members(tr, item):
+            if spilled:
+                self._delete_payload(tr, str(tr[item_key]))
+            del tr[item_key]
+            del tr[member_subspace[priority][count]]
+            removed[priority] = removed.get(priority, 0) - 1
+        self._add_counts(tr, removed)
+
+    @fdb.transactional
+    def reprioritize(self, tr, item, priority, random_ID=None):
+        '''Move item to a new priority, behind the items already there.
+
+        Returns False if the item is not in the queue. If the item is in the
+        queue at several priorities, all of them are replaced by one.'''
+        members = self._get_members(tr, item)
+        if not members:
+            return False
+        if [p for p, _, _ in members] == [priority]:
+            return True
+        member_subspace = self._member_subspace(item)
+        value = str(tr[members[0][2]])
+        removed = {}
+        for p, count, item_key in members:
+            if item_key != members[0][2]:
+                self._delete_payload(tr, str(tr[item_key]))
+            del tr[item_key]
+            del tr[member_subspace[p][count]]
+            removed[p] = removed.get(p, 0) - 1
+        self._add_counts(tr, removed)
+        if random_ID is None:
+            random_ID = _random_ID()
+        count = self._get_next_count(tr.snapshot, self._item[priority])
+        key = self._item[priority][count][random_ID]
+        tr.add_read_conflict_key(key)
+        tr[key] = value
+        tr[member_subspace[priority][count]] = random_ID
+        self._add_count(tr, priority, 1)
+        return True
 
     # Private methods
 
@@ -104,8 +390,117 @@ class PriorityQueue(object):
     def _decode(self, value):
         return fdb.tuple.unpack(value)[0]
 
+    def _decode_count(self, value):
+        if value == None:
+            return 0
+        return struct.unpack('<q', str(value))[0]
+
+    def _compact_periodically(self, db):
+        with self._band_lock:
+            self._pops_since_compact += 1
+            if self._pops_since_compact < self._compact_interval:
+                return
+            self._pops_since_compact = 0
+        self.compact_counts(db)
+
+    def _add_count(self, tr, priority, delta):
+        self._add_counts(tr, {priority: delta})
+
+    # Counts are changed with atomic adds so that pushes and pops at the same
+    # priority don't conflict on them. A priority's count is cleared instead
+    # once it falls to zero, so that emptied priorities don't pile up. That
+    # case is found with a snapshot read, and only then made to conflict with
+    # other changes to the count. Zeros left by concurrent decrements are
+    # cleared by compact_counts().
+    def _add_counts(self, tr, deltas):
+        # Issue all of the reads before waiting on any of them.
+        counts = [(priority, delta, tr.snapshot[self._count[priority].key()] if delta < 0 else None)
+                  for priority, delta in deltas.items() if delta]
+        for priority, delta, count in counts:
+            key = self._count[priority].key()
+            if delta < 0 and self._decode_count(count) + delta <= 0:
+                tr.add_read_conflict_key(key)
+                del tr[key]
+            else:
+                tr.add(key, struct.pack('<q', delta))
+        total = sum(deltas.values())
+        if total:
+            tr.add(self._total.key(), struct.pack('<q', total))
+
+    # Encodes an item for storage in the queue. Items whose encoding is longer
+    # than the spill threshold are written to the payload subspace and stored
+    # as (None, payload ID, digest); an inline item is a one-element tuple.
+    def _store(self, tr, item):
+        encoded = self._encode(item)
+        if len(encoded) <= self._spill_threshold:
+            return encoded
+        payload_ID = _random_ID()
+        for i in range(0, len(encoded), self._chunk_size):
+            tr[self._payload[payload_ID][i]] = encoded[i:i + self._chunk_size]
+        return fdb.tuple.pack((None, payload_ID, hashlib.sha1(encoded).digest()))
+
+    def _load(self, tr, value):
+        t = fdb.tuple.unpack(value)
+        if len(t) == 1:
+            return t[0]
+        return self._decode(''.join(v for _, v in tr[self._payload[t[1]].range()]))
+
+    def _delete_payload(self, tr, value):
+        t = fdb.tuple.unpack(value)
+        if len(t) > 1:
+            del tr[self._payload[t[1]].range()]
+
+    # Loads popped items in the transaction that pops them, and deletes the
+    # payloads of large items in it, so that a payload never outlives its item.
+    def _consume(self, tr, values):
+        stored = [fdb.tuple.unpack(value) for value in values]
+        # Issue all of the reads before waiting on any of them.
+        payloads = [tr[self._payload[t[1]].range()] if len(t) > 1 else None
+                    for t in stored]
+        items = []
+        for t, payload in zip(stored, payloads):
+            if payload is None:
+                items.append(t[0])
+                continue
+            items.append(self._decode(''.join(v for _, v in payload)))
+            del tr[self._payload[t[1]].range()]
+        return items
+
+    # Large items can't be used as keys, so their inverse index is keyed by a
+    # digest of their encoding.
+    def _member_subspace(self, item):
+        encoded = self._encode(item)
+        if len(encoded) <= self._spill_threshold:
+            return self._member[item]
+        return self._large_member[hashlib.sha1(encoded).digest()]
+
+    def _stored_member_subspace(self, value):
+        t = fdb.tuple.unpack(value)
+        if len(t) == 1:
+            return self._member[t[0]]
+        return self._large_member[t[2]]
+
+    # Returns (priority, count, item key) for each position of item. Entries
+    # written before the inverse index recorded random IDs are resolved by
+    # scanning the items at their priority and count.
+    def _get_members(self, tr, item):
+        member_subspace = self._member_subspace(item)
+        members = []
+        for member_key, random_ID in tr[member_subspace.range()]:
+            priority, count = member_subspace.unpack(member_key)
+            if random_ID != '':
+                members.append((priority, count, self._item[priority][count][random_ID].key()))
+                continue
+            for item_key, value in tr[self._item[priority][count].range()]:
+                if self._stored_member_subspace(value).key() == member_subspace.key():
+                    members.append((priority, count, item_key))
+        return members
+
     def _check_at_priority(self, tr, item, priority):
-        r = self._member[item][priority].range()
+        return self._has_member(tr, self._member_subspace(item), priority)
+
+    def _has_member(self, tr, member_subspace, priority):
+        r = member_subspace[priority].range()
         for _ in tr.get_range(r.start, r.stop, limit=1):
             return True
         return False
@@ -126,31 +521,80 @@ class PriorityQueue(object):
         # Protect against the unlikely event that another transaction pushing a 
         # an item with the same priority got the same count and random ID.
         tr.add_read_conflict_key(key)
-        tr[key] = item
-        tr[self._member[self._decode(item)][priority][count]] = ''
+        tr[key] = self._store(tr, item)
+        tr[self._member_subspace(item)[priority][count]] = random_ID
+        self._add_count(tr, priority, 1)
+
+    def _push_stored(self, tr, value, count, priority, random_ID):
+        key = self._item[priority][count][random_ID]
+        tr.add_read_conflict_key(key)
+        tr[key] = value
+        tr[self._stored_member_subspace(value)[priority][count]] = random_ID
+        self._add_count(tr, priority, 1)
 
     def _get_first_item(self, tr, max=False):
-        r = self._item.range()
-        for kv in tr.get_range(r.start, r.stop, limit=1, reverse=max):
+        for kv in self._get_first_items(tr, 1, max):
             return kv
         return None
 
+    def _get_first_items(self, tr, k, max=False, lo=None, hi=None):
+        start, stop = self._band_range(lo, hi)
+        return tr.get_range(start, stop, limit=k, reverse=max)
+
+    # Returns the keys bounding items with priorities in [lo, hi), where None
+    # is unbounded.
+    def _band_range(self, lo, hi):
+        r = self._item.range()
+        start = r.start if lo is None else self._item.pack((lo,))
+        stop = r.stop if hi is None else self._item.pack((hi,))
+        return start, stop
+
+    # Picks the band to serve with smooth weighted round-robin, which spreads
+    # each band's turns evenly instead of serving them in runs. The remaining
+    # bands follow in the order they would be served next, as fallbacks.
+    def _band_order(self):
+        with self._band_lock:
+            total = 0
+            for i, (_, _, weight) in enumerate(self._bands):
+                self._band_cursors[i] += weight
+                total += weight
+            order = sorted(range(len(self._bands)),
+                           key=lambda i: -self._band_cursors[i])
+            self._band_cursors[order[0]] -= total
+        return [self._bands[i][:2] for i in order]
+
     # This implementation of pop does not attempt to avoid conflicts. If many
     # clients try to pop simultaneously, only one will be able to succeed.
     @fdb.transactional
     def _pop_low(self, tr, max):
-        first_item = self._get_first_item(tr, max)
-        if first_item is None:
+        items = self._pop_low_many(tr, 1, max)
+        if not items:
             return None
-        key = first_item.key
-        item = first_item.value
-        del tr[key]
-        priority, count, _ = self._item.unpack(key)
-        del tr[self._member[self._decode(item)][priority][count]]
-        return item
+        return items[0]
+
+    @fdb.transactional
+    def _pop_low_band(self, tr, lo, hi):
+        items = self._pop_low_many(tr, 1, False, lo, hi)
+        if not items:
+            return None
+        return items[0]
+
+    @fdb.transactional
+    def _pop_low_many(self, tr, k, max, lo=None, hi=None):
+        self.promote_due(tr)
+        values = []
+        removed = {}
+        for key, value in self._get_first_items(tr, k, max, lo, hi):
+            del tr[key]
+            priority, count, _ = self._item.unpack(key)
+            del tr[self._stored_member_subspace(value)[priority][count]]
+            removed[priority] = removed.get(priority, 0) - 1
+            values.append(value)
+        self._add_counts(tr, removed)
+        return self._consume(tr, values)
 
     @fdb.transactional
-    def _add_pop_request(self, tr, forced=False):
+    def _add_pop_request(self, tr, max, forced=False, k=1, lo=None, hi=None):
         count = self._get_next_count(tr.snapshot, self._pop_request)
         if count == 0 and not forced:
             return None
@@ -158,61 +602,85 @@ class PriorityQueue(object):
         # Protect against the unlikely event that someone else got the same
         # random ID while adding a pop request.
         tr.add_read_conflict_key(request_key)
-        tr[request_key] = ''
+        tr[request_key] = fdb.tuple.pack((k, int(max), lo, hi))
         return request_key
 
-    def _fulfill_requested_pops(self, db, max):
+    def _fulfill_requested_pops(self, db):
         ''' Retrieve and process a batch of requests and a batch of items. 
 
         We initially attempt to retrieve equally sized batches of each. However,
         the number of outstanding requests need not match the number of 
         available items; either could be larger than the other. We therefore 
         only process a number equal to the smaller of the two.
+
+        A request for k items is handed up to k items at once, stored under the
+        request's random ID in the order they were taken. Requests for minimum
+        and maximum items are served from their own ends of the queue, and
+        requests for a band of priorities from that band's range. When there
+        are too few items for all of them, no item is handed out twice.
         '''
         batch = 100
 
         tr = db.create_transaction()
+        self.promote_due(tr)
         r = self._pop_request.range()
-        requests = list(tr.snapshot.get_range(r.start, r.stop, limit=batch))
-        r = self._item.range()
-        items = tr.snapshot.get_range(
-            r.start, r.stop, limit=batch, reverse=max)
-
-        i = 0
-        for request, (item_key, item_value) in zip(requests, items):
-            random_ID = self._pop_request.unpack(request.key)[1]
-            tr[self._requested_item[random_ID]] = item_value
-            tr.add_read_conflict_key(item_key)
-            tr.add_read_conflict_key(request.key)
-            del tr[request.key]
-            del tr[item_key]
-            priority, count, _ = self._item.unpack(item_key)
-            del tr[self._member[item_value][priority][count]]
-            i += 1
-
-        for request in requests[i:]:
-            tr.add_read_conflict_key(request.key)
-            del tr[request.key]
-
+        requests = [(request.key,) + self._request_size(request.value)
+                    for request in tr.snapshot.get_range(r.start, r.stop, limit=batch)]
+        # Requests are grouped by the end and range of the queue they pop from.
+        wanted = {}
+        for _, k, max, lo, hi in requests:
+            wanted[(max, lo, hi)] = wanted.get((max, lo, hi), 0) + k
+        ends = {}
+        for (max, lo, hi), k in wanted.items():
+            ends[(max, lo, hi)] = iter(
+                self._get_first_items(tr.snapshot, k, bool(max), lo, hi))
+        taken = set()
+        removed = {}
+
+        for request_key, k, max, lo, hi in requests:
+            random_ID = self._pop_request.unpack(request_key)[1]
+            tr.add_read_conflict_key(request_key)
+            del tr[request_key]
+            items = (kv for kv in ends[(max, lo, hi)] if kv.key not in taken)
+            for j, (item_key, item_value) in zip(range(k), items):
+                taken.add(item_key)
+                tr[self._requested_item[random_ID][j]] = item_value
+                tr.add_read_conflict_key(item_key)
+                del tr[item_key]
+                priority, count, _ = self._item.unpack(item_key)
+                del tr[self._stored_member_subspace(item_value)[priority][count]]
+                removed[priority] = removed.get(priority, 0) - 1
+
+        self._add_counts(tr, removed)
         tr.commit().wait()
 
+    # Returns (k, max, lo, hi) for a pop request. Requests written before they
+    # recorded their direction pop one minimum item from the whole queue.
+    def _request_size(self, value):
+        t = fdb.tuple.unpack(value) if value else ()
+        k = t[0] if len(t) > 0 else 1
+        max = t[1] if len(t) > 1 else 0
+        lo = t[2] if len(t) > 2 else None
+        hi = t[3] if len(t) > 3 else None
+        return k, max, lo, hi
+
     # This implementation of pop avoids conflicts by registering a pop request
     # in a semi-ordered set of requests if it doesn't initially succeed. It then
     # enters a retry loop that attempts to fulfill outstanding requests and
     # checks to see if its request has been fulfilled.
-    def _pop_high(self, db, max):
+    def _pop_high(self, db, max, k=1, lo=None, hi=None):
 
         tr = db.create_transaction()
 
         try:
             # Check if there are outstanding pop requests. If so, we may not pop
             # before them.
-            request_key = self._add_pop_request(tr)
+            request_key = self._add_pop_request(tr, max, k=k, lo=lo, hi=hi)
             if request_key is None:
                 # No outstanding requests, so just pop.
-                item = self._pop_low(tr, max)
+                items = self._pop_low_many(tr, k, max, lo, hi)
                 tr.commit().wait()
-                return item
+                return items
             else:
                 # Commit the added pop request.
                 tr.commit().wait()
@@ -220,14 +688,14 @@ class PriorityQueue(object):
         except fdb.FDBError as e:
             # If we didn't succeed, then register our pop request with a 
             # separate transaction.
-            request_key = self._add_pop_request(db, True)
+            request_key = self._add_pop_request(db, max, True, k, lo, hi)
 
         # Our pop request is now registered.
 
-        # When the request is eventually fufilled, its result will be stored at
-        # a unique key formed from its random ID.
+        # When the request is eventually fufilled, its results will be stored
+        # in a unique subspace formed from its random ID.
         random_ID = self._pop_request.unpack(request_key)[1]
-        result_key = self._requested_item[random_ID]
+        result_range = self._requested_item[random_ID].range()
 
         # Here we logically start a new transaction, reusing the old 
         # transaction object only for efficiency.
@@ -240,7 +708,7 @@ class PriorityQueue(object):
         while True:
             try:
                 # Fulfill requests in a separate transaction.
-                self._fulfill_requested_pops(db, max)
+                self._fulfill_requested_pops(db)
             except fdb.FDBError as e:
                 # If the error is 1020 (not_committed), then another client has
                 # probably fulfilled a batch of requests. In that case, we check
@@ -255,17 +723,18 @@ class PriorityQueue(object):
 
                 if tr[request_key].present():
                     # Our request is still pending; try again until it isn't.
-                    time.sleep(backoff)
+                    self._sleep(backoff)
                     backoff = min(1, backoff * 2)
                     continue
                 
-                result = tr[result_key]
-                if not result.present():
-                    return None
+                results = [v for _, v in tr[result_range]]
+                if not results:
+                    return results
 
-                del tr[result_key]
+                del tr[result_range]
+                items = self._consume(tr, results)
                 tr.commit().wait()
-                return result
+                return items
 
             except fdb.FDBError as e:
                 tr.on_error(e.code).wait()
@@ -274,6 +743,14 @@ def _random_ID():
     # Relies on good random data from the OS to avoid collisions
     return os.urandom(20)
 
+# Times are stored as integer milliseconds, since the tuple layer doesn't
+# encode floating point numbers.
+def _to_ms(t):
+    return int(t * 1000)
+
+def _now_ms():
+    return _to_ms(time.time())
+
 ##################
 # Internal tests #
 ##################
@@ -301,11 +778,69 @@ def smoke_test(db, max):
     print 'Empty? %s' % pq.isempty(db)
     print 'Push 5'
     pq.push(db, 5, 5, _random_ID())
+    print 'Push 1, 2, 3'
+    for i in (1, 2, 3):
+        pq.push(db, i, i, _random_ID())
+    print 'Move 3 to priority 0'
+    pq.reprioritize(db, 3, 0)
+    print 'Remove 2'
+    pq.remove(db, 2)
+    print 'Size: %d, histogram: %s' % (pq.size(db), pq.histogram(db))
+    print 'Lose the counts and recount'
+    del db[pq._count.range()]
+    pq.recount(db)
+    print 'Size: %d, histogram: %s' % (pq.size(db), pq.histogram(db))
+    print 'Next 2 items: %s' % pq.peek_many(db, 2, max)
+    print 'Pop 3 items: %s' % pq.pop_many(db, 3, max)
+    print 'Push 7 not before 1 second from now, 9 now'
+    pq.push(db, 7, 7, _random_ID(), time.time() + 1)
+    pq.push(db, 9, 9, _random_ID())
+    leased = pq.lease(db, 1, 0, max)
+    print 'Lease item: %s' % leased
+    assert [item for _, item in leased] == [9]
+    print 'Empty? %s' % pq.isempty(db)
+    print 'Reclaimed %d items' % pq.reclaim_expired(db)
+    leased = pq.lease(db, 1, 60, max)
+    print 'Lease item: %s' % leased
+    assert [item for _, item in leased] == [9]
+    print 'Acked %d items' % pq.ack(db, [l for l, _ in leased])
+    print 'Reclaimed %d items' % pq.reclaim_expired(db)
+    print 'Push 9 again, lease it and let the lease expire'
+    pq.push(db, 9, 9, _random_ID())
+    pq.lease(db, 1, 0, max)
+    print 'Reclaimed %d items' % pq.reclaim_expired(db)
+    print 'Pop item: %s' % pq.pop(db, max)
+    time.sleep(1)
+    print 'Pop item: %s' % pq.pop(db, max)
+    print 'Push 1MB item'
+    pq.push(db, 'x' * 1000000, 4, _random_ID())
+    print 'Pop item of length %d' % len(pq.pop(db, False))
     print 'Clear Priority Queue'
     pq.clear(db)
     print 'Empty? %s' % pq.isempty(db)
 
 
+def drain_client(db, ops=200, clients=10):
+    import gevent
+    print "\nRunning concurrent drain test:"
+    pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), False,
+                       sleep=gevent.sleep)
+    pq.clear(db)
+    for i in range(ops):
+        pq.push(db, i, i % 5, _random_ID())
+    # Drain from both ends at once, so that pops at the same priority race
+    def drain(max):
+        while pq.pop(db, max) is not None:
+            pass
+    gevent.joinall([gevent.spawn(drain, i % 2 == 1) for i in range(clients)])
+    assert pq.size(db) == 0
+    # The next pop compacts the counts
+    pq._compact_interval = 1
+    assert pq.pop(db) is None
+    r = pq._count.range()
+    assert list(db.get_range(r.start, r.stop)) == []
+    print 'No counts left'
+
 def single_client(db, ops):
     print "\nRunning single client example:"
     pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), False)
@@ -330,13 +865,24 @@ def consumer(pq, db, id, total):
             print 'Greenlet %d popped None' % id
     print 'Finished greenlet %d' % id
 
-import gevent
+def fair_client(db, ops):
+    print "\nRunning weighted-fair example:"
+    pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), False,
+                       bands=[(0, 3), (10, 1)])
+    pq.clear(db)
+    for i in range(ops):
+        pq.push(db, 'urgent.%d' % i, 0, _random_ID())
+        pq.push(db, 'normal.%d' % i, 10, _random_ID())
+    for i in range(ops):
+        print pq.pop_fair(db)
 
 
 def multi_client(db, ops, clients, high):
+    import gevent
     description = "high-contention" if high else "low-contention"
     print '\nStarting %s test:' % description
-    pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), high)
+    pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), high,
+                       sleep=gevent.sleep)
     pq.clear(db)
     start = time.time()
     producers = [gevent.spawn(producer, pq, db, i, ops)
@@ -348,9 +894,45 @@ def multi_client(db, ops, clients, high):
     end = time.time()
     print 'Finished %s queue in %f seconds' % (description, end - start)
 
+def directional_consumer(pq, db, total, max, popped):
+    for i in range(total):
+        item = pq.pop(db, max)
+        if item is not None:
+            popped.append(item)
+
+
+def double_ended_client(db, ops, client_counts=(1, 5, 10, 20)):
+    '''Pop from both ends at once with equal numbers of min and max poppers.
+
+    Reports the pop rate of each end, and how many items each end took from
+    the other end's half of the queue.'''
+    import gevent
+    print '\nStarting double-ended high-contention test:'
+    pq = PriorityQueue(fdb.directory.create_or_open(db, ('P',)), True,
+                       sleep=gevent.sleep)
+    for clients in client_counts:
+        pq.clear(db)
+        total = 2 * clients * ops
+        for i in range(total):
+            pq.push(db, i, i, _random_ID())
+        popped = ([], [])
+        start = time.time()
+        consumers = [gevent.spawn(directional_consumer, pq, db, ops, max,
+                                  popped[max])
+                     for max in (False, True) for i in range(clients)]
+        gevent.joinall(consumers)
+        elapsed = time.time() - start
+        wrong_min = len([i for i in popped[False] if i >= total / 2])
+        wrong_max = len([i for i in popped[True] if i < total / 2])
+        print '%d+%d clients: min %f pops/s (%d wrong end), max %f pops/s (%d wrong end)' % (
+            clients, clients, len(popped[False]) / elapsed, wrong_min,
+            len(popped[True]) / elapsed, wrong_max)
+
 if __name__ == '__main__':
     db = fdb.open(event_model="gevent")
     #smoke_test(db, False)
     #single_client(db, 10)
     #multi_client(db, 100, 10, False)
     multi_client(db, 100, 10, True)
+    #double_ended_client(db, 100)
+    #drain_client(db)
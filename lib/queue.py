@@ -11,10 +11,50 @@ popping clients.
 If high contention mode is off, then no attempt will be made to avoid
 transaction conflicts in pop operations. This mode performs well with
 only one popping client, but will not scale well to many popping clients.
+
+Items can also be consumed with at-least-once semantics by leasing them
+instead of popping them. A leased item is moved into an in-flight index
+ordered by the time its lease expires. It is removed for good when the
+consumer acknowledges it; otherwise a sweep returns it to the queue once
+its lease has expired.
+
+The queue maintains counts of pending items, leased items, waiting pop
+requests and fulfilled pop results with atomic adds, so its size can be
+read without scanning the items. A queue written before the counts were
+maintained should be recounted once with recount(); until then its counts
+are too low, and are read as no less than zero.
+
+In high contention mode, outstanding pop requests are fulfilled in batches
+sized from the number of waiting requests and shrunk when fulfillment
+transactions conflict. Only one client at a time, elected through a
+short-lived fulfiller lease, attempts to fulfill a round of requests.
+
+Passing highContention='auto' picks the mode per pop. Pops start in the
+simple mode, and the queue switches to high contention mode while the
+recent rate of contended pops is high and back once it has fallen. The
+measurements behind each switch are available from contentionStats().
+
+A queue created with log=True is instead consumed like a log. Items are not
+popped; they stay in place while each consumer group reads batches from its
+own committed offset, and can be replayed by moving the offset back. trim()
+removes the items that every group has consumed.
+
+Items pushed with a delivery time are held in a separate subspace ordered by
+that time, and are moved onto the queue in bulk once they are due, inside the
+transaction of the next pop, lease, peek or (in log mode) group read.
+Consumers never see an item before its delivery time.
+
+Large items are stored out of line in chunks, and only a small reference to
+them moves through the queue. The payload is read back when the item is
+consumed, so large items don't bloat the fulfillment transactions of the
+high contention mode or run into the value size limit.
 """
 
 import time
 import os
+import struct
+import threading
+import collections
 
 import fdb
 import fdb.tuple
@@ -27,54 +67,400 @@ fdb.api_version(200)
 
 class Queue:
     # Public functions
-    def __init__(self, subspace, highContention=True):
+    def __init__(self, subspace, highContention=True, log=False, sleep=time.sleep):
         self.subspace = subspace
         self.highContention = highContention
+        self.log = log
 
         self._conflictedPop = self.subspace['pop']
         self._conflictedItem = self.subspace['conflict']
         self._queueItem = self.subspace['item']
 
+        # Leased items are stored at (expiry, leaseID) so that expired leases
+        # can be found with a single range read. The lease index maps a
+        # leaseID back to its expiry.
+        self._leasedItem = self.subspace['leased']
+        self._leaseIndex = self.subspace['lease']
+
+        # Payloads of large items are stored at (payloadID, chunk). Encoded items
+        # longer than the spill threshold are replaced by a reference.
+        self._payload = self.subspace['payload']
+        self._spillThreshold = 1000
+        self._chunkSize = 10000
+
+        # Delayed items are stored at (deliverAt, randomID) until they are due.
+        self._delayedItem = self.subspace['delayed']
+
+        # Consumer group offsets in log mode. Each group stores the key of the
+        # last item it has consumed, or '' if it has consumed nothing.
+        self._groupOffset = self.subspace['offset']
+
+        # The index after the last item removed by trim() in log mode, so that
+        # a trimmed log never reuses an index behind a group's offset.
+        self._trimmedIndex = self.subspace['trimmed']
+
+        # Counts maintained with atomic adds, keyed by name.
+        self._count = self.subspace['count']
+
+        # The client currently fulfilling pop requests in high contention mode
+        # holds this key as (fulfillerID, expiry).
+        self._fulfiller = self.subspace['fulfiller']
+
+        # Fulfillment batch size, adapted to how often fulfillment conflicts.
+        self._minFulfillBatch = 1
+        self._maxFulfillBatch = 100
+        self._fulfillBatch = self._maxFulfillBatch
+        self._fulfillerLease = 0.25
+
+        # Used to wait between polls for a pop request. Pass a cooperative
+        # sleep such as gevent.sleep to wait without blocking other greenlets.
+        self._sleep = sleep
+
+        # Contention tracking for the automatic mode. The contention rate is an
+        # exponential moving average of the fraction of pops that conflicted
+        # (simple mode) or had to register a pop request (high contention mode).
+        self._autoHighContention = False
+        self._contentionRate = 0.0
+        self._contentionWeight = 0.1
+        self._enterHighContention = 0.3
+        self._leaveHighContention = 0.05
+        self._pops = 0
+        self._contendedPops = 0
+        self._conflicts = 0
+        self._modeSwitches = collections.deque(maxlen=100)
+        self._contentionLock = threading.Lock()
+
     @fdb.transactional
     def clear(self, tr):
         """Remove all items from the queue."""
         del tr[self.subspace.range()]
 
     @fdb.transactional
-    def push(self, tr, value):
-        """Push a single item onto the queue."""
-        index = self._getNextIndex(tr.snapshot, self._queueItem)
-        self._pushAt(tr, self._encodeValue(value), index)
+    def push(self, tr, value, deliverAt=None):
+        """Push a single item onto the queue.
+
+        If deliverAt (a time as returned by time.time()) is given and in the
+        future, the item is not visible to consumers until that time.
+        """
+        if deliverAt is not None and int(deliverAt * 1000) > self._now():
+            key = self._delayedItem.pack((int(deliverAt * 1000), self._randID()))
+            tr.add_read_conflict_key(key)
+            tr[key] = self._storeValue(tr, value)
+            self._addCount(tr, 'delayed', 1)
+            return
+
+        self._pushAt(tr, self._storeValue(tr, value), self._getNextItemIndex(tr))
 
     def pop(self, db):
         """Pop the next item from the queue. Cannot be composed with other functions in a single transaction."""
 
-        if self.highContention:
+        if self.log:
+            raise Exception('Items cannot be popped from a queue in log mode')
+
+        if self.highContention == 'auto':
+            if self._autoHighContention:
+                result = self._popHighContention(db)
+            else:
+                result = self._popSimpleTracked(db)
+        elif self.highContention:
             result = self._popHighContention(db)
         else:
-            result = self._popSimple(db)
+            result = self._popSimpleTracked(db)
 
         if result is None:
             return result
 
-        return self._decodeValue(result)
+        return self._consumeValue(db, result)
 
     @fdb.transactional
     def empty(self, tr):
-        """Test whether the queue is empty."""
+        """Test whether the queue is empty.
+
+        Delayed items that are due are first moved onto the queue, as by pop().
+        """
+        self.promoteDue(tr)
         return self._getFirstItem(tr) is None
 
     @fdb.transactional
     def peek(self, tr):
-        """Get the value of the next item in the queue without popping it."""
+        """Get the value of the next item in the queue without popping it.
+
+        Delayed items that are due are first moved onto the queue, as by pop().
+        """
+        self.promoteDue(tr)
         firstItem = self._getFirstItem(tr)
         if firstItem is None:
             return None
         else:
-            return self._decodeValue(firstItem.value)
+            return self._loadValue(tr, firstItem.value)
+
+    @fdb.transactional
+    def size(self, tr):
+        """Get the number of items waiting in the queue, excluding leased items."""
+        return self._getCount(tr, 'pending')
+
+    @fdb.transactional
+    def stats(self, tr):
+        """Get a dictionary of the queue's maintained counts.
+
+        The counts are 'pending' items, 'delayed' items that are not yet due,
+        'leased' items, 'waiting' pop requests and 'conflicted' pop results
+        that have not yet been collected.
+        """
+        names = ('pending', 'delayed', 'leased', 'waiting', 'conflicted')
+        counts = [tr[self._count.pack((name,))] for name in names]
+        return dict((name, self._decodeCount(c)) for name, c in zip(names, counts))
+
+    @fdb.transactional
+    def recount(self, tr):
+        """Recompute the maintained counts from the items in the queue.
+
+        Every key of the queue is read in a single transaction, so the queue
+        must be small enough to be read within the transaction limits.
+        """
+        subspaces = (('pending', self._queueItem), ('delayed', self._delayedItem),
+                     ('leased', self._leasedItem), ('waiting', self._conflictedPop),
+                     ('conflicted', self._conflictedItem))
+        # Issue all of the reads before waiting on any of them.
+        ranges = [(name, tr[subspace.range()]) for name, subspace in subspaces]
+        for name, r in ranges:
+            tr[self._count.pack((name,))] = self._encodeCount(len(list(r)))
+
+    def contentionStats(self):
+        """Get the contention measurements of this client's pops.
+
+        Returns a dictionary with the current automatic mode, the recent
+        contention rate, the number of pops, contended pops and transaction
+        conflicts seen by this client, and the most recent automatic mode
+        switches as (time, highContention, contentionRate) tuples.
+        """
+        with self._contentionLock:
+            return {
+                'highContention': self._autoHighContention,
+                'contentionRate': self._contentionRate,
+                'pops': self._pops,
+                'contendedPops': self._contendedPops,
+                'conflicts': self._conflicts,
+                'switches': list(self._modeSwitches),
+            }
+
+    @fdb.transactional
+    def lease(self, tr, n=1, timeout=30):
+        """Lease up to n items from the front of the queue for timeout seconds.
+
+        Returns a list of (leaseID, value) pairs. Each item stays invisible to
+        other consumers until it is acknowledged with ack() or its lease expires
+        and it is returned to the queue by sweepExpired().
+        """
+        if self.log:
+            raise Exception('Items cannot be leased from a queue in log mode')
+
+        self.promoteDue(tr)
+
+        expiry = self._now() + int(timeout * 1000)
+        leased = []
+        for k, v in self._getItems(tr, n):
+            leaseID = self._randID()
+            del tr[k]
+            tr[self._leasedItem.pack((expiry, leaseID))] = fdb.tuple.pack((k, v))
+            tr[self._leaseIndex.pack((leaseID,))] = fdb.tuple.pack((expiry, self._payloadID(v)))
+            leased.append((leaseID, self._loadValue(tr, v)))
+        self._addCount(tr, 'pending', -len(leased))
+        self._addCount(tr, 'leased', len(leased))
+        return leased
+
+    @fdb.transactional
+    def ack(self, tr, leaseIDs):
+        """Acknowledge leased items, removing them from the queue for good.
+
+        Returns the number of leases that were still held. Leases that have
+        already expired and been swept are ignored.
+        """
+        # Issue all of the reads before waiting on any of them.
+        expiries = [(leaseID, tr[self._leaseIndex.pack((leaseID,))])
+                    for leaseID in leaseIDs]
+        acked = 0
+        for leaseID, expiry in expiries:
+            if not expiry.present():
+                continue
+            expiry, payloadID = fdb.tuple.unpack(expiry)
+            if payloadID is not None:
+                del tr[self._payload.range((payloadID,))]
+            del tr[self._leaseIndex.pack((leaseID,))]
+            del tr[self._leasedItem.pack((expiry, leaseID))]
+            acked += 1
+        self._addCount(tr, 'leased', -acked)
+        return acked
+
+    @fdb.transactional
+    def sweepExpired(self, tr, limit=100):
+        """Return up to limit items with expired leases to the queue.
+
+        Returns the number of items returned. Items go back to their original
+        position, so they are consumed before items pushed after them.
+        """
+        r = self._leasedItem.range()
+        swept = 0
+        for k, v in tr.get_range(r.start, self._leasedItem.range((self._now(),)).stop, limit):
+            leaseID = self._leasedItem.unpack(k)[1]
+            itemKey, value = fdb.tuple.unpack(v)
+            tr[itemKey] = value
+            del tr[k]
+            del tr[self._leaseIndex.pack((leaseID,))]
+            swept += 1
+        self._addCount(tr, 'leased', -swept)
+        self._addCount(tr, 'pending', swept)
+        return swept
+
+    @fdb.transactional
+    def promoteDue(self, tr, limit=100):
+        """Move up to limit delayed items that are due onto the queue.
+
+        Returns the number of items moved. Only due items are read. Items are
+        pushed in the order of their delivery times.
+        """
+        r = self._delayedItem.range()
+        end = self._delayedItem.range((self._now(),)).stop
+        # Checked at snapshot isolation first, so that consumers calling this
+        # while nothing is due don't conflict with each other or with pushes.
+        if not list(tr.snapshot.get_range(r.start, end, 1)):
+            return 0
+
+        due = list(tr.get_range(r.start, end, limit))
+        if not due:
+            return 0
+
+        index = self._getNextItemIndex(tr)
+        for i, (k, v) in enumerate(due):
+            self._pushAt(tr, v, index + i)
+        del tr[r.start : due[-1].key + '\x00']
+        self._addCount(tr, 'delayed', -len(due))
+        return len(due)
+
+    @fdb.transactional
+    def subscribe(self, tr, group, fromStart=True):
+        """Register a consumer group in log mode.
+
+        The group starts at the oldest item in the queue, or after the newest
+        item if fromStart is False. No effect if the group already exists.
+        """
+        if tr[self._groupOffset.pack((group,))].present():
+            return
+        offset = ''
+        if not fromStart:
+            lastKey = tr.get_key(fdb.KeySelector.last_less_than(self._queueItem.range().stop))
+            if lastKey >= self._queueItem.range().start:
+                offset = lastKey
+        tr[self._groupOffset.pack((group,))] = offset
+
+    @fdb.transactional
+    def unsubscribe(self, tr, group):
+        """Remove a consumer group, so that it no longer holds back trim()."""
+        del tr[self._groupOffset.pack((group,))]
+
+    @fdb.transactional
+    def readGroup(self, tr, group, n=100):
+        """Read up to n items after the group's committed offset.
+
+        Returns a list of (position, value) pairs in queue order. The offset is
+        not moved; pass the last position to commitGroup() once the items have
+        been processed. Delayed items that are due are first appended to the
+        queue.
+        """
+        self.promoteDue(tr)
+        begin = self._groupBegin(tr, group)
+        return [(self._queueItem.unpack(k), self._loadValue(tr, v))
+                for k, v in tr.get_range(begin, self._queueItem.range().stop, n)]
+
+    @fdb.transactional
+    def commitGroup(self, tr, group, position):
+        """Commit the group's offset, marking every item up to and including position as consumed."""
+        self._getGroupOffset(tr, group)
+        tr[self._groupOffset.pack((group,))] = self._queueItem.pack(tuple(position))
+
+    @fdb.transactional
+    def consumeGroup(self, tr, group, n=100):
+        """Read up to n items after the group's offset and commit past them in the same transaction."""
+        items = self.readGroup(tr, group, n)
+        if items:
+            self.commitGroup(tr, group, items[-1][0])
+        return [v for _, v in items]
+
+    @fdb.transactional
+    def seekGroup(self, tr, group, position=None):
+        """Move the group's offset back to replay items.
+
+        With no position the group replays every item still in the queue.
+        Otherwise it resumes with the first item after position.
+        """
+        self._getGroupOffset(tr, group)
+        if position is None:
+            offset = ''
+        else:
+            offset = self._queueItem.pack(tuple(position))
+        tr[self._groupOffset.pack((group,))] = offset
+
+    @fdb.transactional
+    def trim(self, tr, limit=1000):
+        """Remove up to limit items that every consumer group has consumed.
+
+        Returns the number of items removed. Nothing is removed while there
+        are no consumer groups.
+        """
+        r = self._groupOffset.range()
+        offsets = [v for _, v in tr.get_range(r.start, r.stop)]
+        if not offsets or '' in offsets:
+            return 0
+
+        end = fdb.KeySelector.first_greater_than(min(offsets))
+        keys = []
+        for k, v in tr.get_range(self._queueItem.range().start, end, limit):
+            payloadID = self._payloadID(v)
+            if payloadID is not None:
+                del tr[self._payload.range((payloadID,))]
+            keys.append(k)
+        if not keys:
+            return 0
+
+        del tr[self._queueItem.range().start : keys[-1] + '\x00']
+        tr[self._trimmedIndex.key()] = fdb.tuple.pack((self._queueItem.unpack(keys[-1])[0] + 1,))
+        self._addCount(tr, 'pending', -len(keys))
+        return len(keys)
 
     # Private functions
 
+    def _getGroupOffset(self, tr, group):
+        offset = tr[self._groupOffset.pack((group,))]
+        if not offset.present():
+            raise Exception('Consumer group %r is not subscribed' % (group,))
+        return str(offset)
+
+    def _groupBegin(self, tr, group):
+        offset = self._getGroupOffset(tr, group)
+        if offset == '':
+            return self._queueItem.range().start
+        return fdb.KeySelector.first_greater_than(offset)
+
+    def _now(self):
+        return int(time.time() * 1000)
+
+    def _encodeCount(self, c):
+        return struct.pack('<q', c)
+
+    # Counts of a queue that hasn't been recounted since it was written by an
+    # earlier version can fall below zero.
+    def _decodeCount(self, v):
+        if not v.present():
+            return 0
+        return max(0, struct.unpack('<q', str(v))[0])
+
+    def _addCount(self, tr, name, delta):
+        if delta:
+            tr.add(self._count.pack((name,)), self._encodeCount(delta))
+
+    def _getCount(self, tr, name):
+        return self._decodeCount(tr[self._count.pack((name,))])
+
     def _conflictedItemKey(self, subKey):
         return self._conflictedItem.pack((subKey,))
 
@@ -87,6 +473,42 @@ class Queue:
     def _decodeValue(self, value):
         return fdb.tuple.unpack(value)[0]
 
+    # Encodes a value for storage in the queue. Values whose encoding is longer
+    # than the spill threshold are written to the payload subspace, and are
+    # represented in the queue by (None, payloadID), which can't be confused
+    # with the single-element tuple of an inline value.
+    def _storeValue(self, tr, value):
+        encoded = self._encodeValue(value)
+        if len(encoded) <= self._spillThreshold:
+            return encoded
+
+        payloadID = self._randID()
+        for i in range(0, len(encoded), self._chunkSize):
+            tr[self._payload.pack((payloadID, i))] = encoded[i:i + self._chunkSize]
+        return fdb.tuple.pack((None, payloadID))
+
+    def _payloadID(self, value):
+        t = fdb.tuple.unpack(value)
+        if len(t) == 1:
+            return None
+        return t[1]
+
+    def _loadValue(self, tr, value):
+        payloadID = self._payloadID(value)
+        if payloadID is None:
+            return self._decodeValue(value)
+        return self._decodeValue(''.join(v for _, v in tr[self._payload.range((payloadID,))]))
+
+    # Popped values are loaded after the pop has committed, and their payload
+    # is deleted in the same transaction that reads it.
+    @fdb.transactional
+    def _consumeValue(self, tr, value):
+        payloadID = self._payloadID(value)
+        value = self._loadValue(tr, value)
+        if payloadID is not None:
+            del tr[self._payload.range((payloadID,))]
+        return value
+
     # Items are pushed on the queue at an (index, randomID) pair. Items pushed at the
     # same time will have the same index, and so their ordering will be random.
     # This makes pushes fast and usually conflict free (unless the queue becomes empty
@@ -95,6 +517,20 @@ class Queue:
         key = self._queueItem.pack((index, self._randID()))
         read = tr[key]
         tr[key] = value
+        self._addCount(tr, 'pending', 1)
+
+    def _getNextItemIndex(self, tr):
+        if self.log:
+            # Consumer groups read past items by key, so a push must never land
+            # behind an item that has already been read, even once trim() has
+            # removed it. A serializable read of the last index makes concurrent
+            # pushes at the same index conflict.
+            trimmed = tr[self._trimmedIndex.key()]
+            index = self._getNextIndex(tr, self._queueItem)
+            if trimmed.present():
+                index = max(index, fdb.tuple.unpack(trimmed)[0])
+            return index
+        return self._getNextIndex(tr.snapshot, self._queueItem)
 
     def _getNextIndex(self, tr, subspace):
         lastKey = tr.get_key(fdb.KeySelector.last_less_than(subspace.range().stop))
@@ -110,16 +546,61 @@ class Queue:
 
         return None
 
+    # Records whether a pop was contended and how many conflicts it hit. In
+    # automatic mode, switches modes when the contention rate crosses a
+    # threshold. The thresholds differ so that the mode doesn't flap when the
+    # rate hovers near one of them.
+    def _recordPop(self, contended, conflicts=0):
+        with self._contentionLock:
+            self._pops += 1
+            self._conflicts += conflicts
+            if contended:
+                self._contendedPops += 1
+
+            w = self._contentionWeight
+            self._contentionRate = (1 - w) * self._contentionRate + w * (1.0 if contended else 0.0)
+
+            if self.highContention != 'auto':
+                return
+
+            if self._autoHighContention:
+                switch = self._contentionRate < self._leaveHighContention
+            else:
+                switch = self._contentionRate > self._enterHighContention
+
+            if switch:
+                self._autoHighContention = not self._autoHighContention
+                self._modeSwitches.append((time.time(), self._autoHighContention, self._contentionRate))
+
+    # A simple pop with an explicit retry loop, so that conflicts can be counted.
+    def _popSimpleTracked(self, db):
+        tr = db.create_transaction()
+        conflicts = 0
+        while 1:
+            try:
+                item = self._popSimple(tr)
+                tr.commit().wait()
+                break
+            except fdb.FDBError as e:
+                if e.code == 1020:
+                    conflicts += 1
+                tr.on_error(e.code).wait()
+
+        self._recordPop(conflicts > 0, conflicts)
+        return item
+
     # This implementation of pop does not attempt to avoid conflicts. If many clients
     # are trying to pop simultaneously, only one will be able to succeed at a time.
     @fdb.transactional
     def _popSimple(self, tr):
 
+        self.promoteDue(tr)
         firstItem = self._getFirstItem(tr)
         if firstItem is None:
             return None
 
         del tr[firstItem.key]
+        self._addCount(tr, 'pending', -1)
         return firstItem.value
         
     @fdb.transactional
@@ -132,6 +613,7 @@ class Queue:
         waitKey = self._conflictedPop.pack((index, self._randID()))
         read = tr[waitKey]
         tr[waitKey] = ''
+        self._addCount(tr, 'waiting', 1)
         return waitKey
         
     def _getWaitingPops(self, tr, numPops):
@@ -142,10 +624,38 @@ class Queue:
         r = self._queueItem.range()
         return tr.get_range(r.start, r.stop, numItems)
 
-    def _fulfillConflictedPops(self, db):
-        numPops = 100
+    # Only the holder of the fulfiller lease attempts to fulfill pops, so that
+    # waiting poppers don't all race to fulfill the same batch. The lease is
+    # short so that a crashed fulfiller is quickly replaced.
+    @fdb.transactional
+    def _electFulfiller(self, tr, fulfillerID):
+        holder = tr[self._fulfiller.key()]
+        if holder.present():
+            holderID, expiry = fdb.tuple.unpack(holder)
+            if holderID != fulfillerID and expiry > self._now():
+                return False
+
+        expiry = self._now() + int(self._fulfillerLease * 1000)
+        tr[self._fulfiller.key()] = fdb.tuple.pack((fulfillerID, expiry))
+        return True
+
+    @fdb.transactional
+    def _releaseFulfiller(self, tr, fulfillerID):
+        holder = tr[self._fulfiller.key()]
+        if holder.present() and fdb.tuple.unpack(holder)[0] == fulfillerID:
+            del tr[self._fulfiller.key()]
 
+    # The batch size is bounded by the number of waiting pops, halved when the
+    # fulfilling transaction conflicts and doubled when it commits.
+    def _fulfillConflictedPops(self, db):
         tr = db.create_transaction()
+        self.promoteDue(tr)
+        waiting = self._getCount(tr.snapshot, 'waiting')
+        if not waiting:
+            # At least this client is waiting, so the count is out of date
+            waiting = self._fulfillBatch
+        numPops = max(1, min(self._fulfillBatch, waiting))
+
         pops = self._getWaitingPops(tr.snapshot, numPops)
         items = self._getItems(tr.snapshot, numPops)
 
@@ -165,7 +675,18 @@ class Queue:
             read = tr[pop.key]
             del tr[pop.key]
 
-        tr.commit().wait()
+        self._addCount(tr, 'pending', -i)
+        self._addCount(tr, 'conflicted', i)
+        self._addCount(tr, 'waiting', -len(pops))
+
+        try:
+            tr.commit().wait()
+        except fdb.FDBError as e:
+            if e.code == 1020:
+                self._fulfillBatch = max(self._minFulfillBatch, self._fulfillBatch // 2)
+            raise
+
+        self._fulfillBatch = min(self._maxFulfillBatch, self._fulfillBatch * 2)
         return len(pops) < numPops
 
     # This implementation of pop attempts to avoid collisions by registering
@@ -175,6 +696,7 @@ class Queue:
     def _popHighContention(self, db):
 
         backoff = 0.01
+        conflicts = 0
 
         tr = db.create_transaction()
 
@@ -186,25 +708,35 @@ class Queue:
                 # No one else was waiting to be popped
                 item = self._popSimple(tr)
                 tr.commit().wait()
+                self._recordPop(False)
                 return item
             else:
                 tr.commit().wait()
 
         except fdb.FDBError as e:
             # If we didn't succeed, then register our pop request
+            if e.code == 1020:
+                conflicts += 1
             waitKey = self._addConflictedPop(db, True)
 
+        self._recordPop(True, conflicts)
+
         # The result of the pop will be stored at this key once it has been fulfilled
         resultKey = self._conflictedItemKey(self._conflictedPop.unpack(waitKey)[1])
 
         tr.reset()
 
-        # Attempt to fulfill outstanding pops and then poll the database 
-        # checking if we have been fulfilled
+        fulfillerID = self._randID()
+        fulfilling = False
+
+        # Attempt to fulfill outstanding pops if we are the elected fulfiller,
+        # and then poll the database checking if we have been fulfilled
         while 1:
             try:
-                while not self._fulfillConflictedPops(db):
-                    pass
+                if self._electFulfiller(db, fulfillerID):
+                    fulfilling = True
+                    while not self._fulfillConflictedPops(db):
+                        pass
             except fdb.FDBError as e:
                 # If the error is 1020 (not_committed), then there is a good chance 
                 # that somebody else has managed to fulfill some outstanding pops. In
@@ -213,6 +745,8 @@ class Queue:
                 if e.code != 1020:
                     tr.on_error(e.code).wait()
                     continue
+                with self._contentionLock:
+                    self._conflicts += 1
 
             try:
                 tr.reset()
@@ -221,20 +755,28 @@ class Queue:
 
                 # If waitKey is present, then we have not been fulfilled
                 if value.present():
-                    time.sleep(backoff)
+                    self._sleep(backoff)
                     backoff = min(1, backoff * 2)
                     continue
 
                 if not result.present():
-                    return None
+                    result = None
+                    break
 
                 del tr[resultKey]
+                self._addCount(tr, 'conflicted', -1)
                 tr.commit().wait()
-                return result
+                break
                 
             except fdb.FDBError as e:
                 tr.on_error(e.code).wait()
 
+        # Hand off the fulfiller lease rather than letting it expire
+        if fulfilling:
+            self._releaseFulfiller(db, fulfillerID)
+
+        return result
+
 ##################
 # Internal tests #
 ##################
@@ -249,6 +791,7 @@ def queue_test(db):
     queue.push(db, 8) 
     queue.push(db, 6) 
     print 'Empty? %s' % queue.empty(db)
+    print 'Size: %d' % queue.size(db)
     print 'Pop item: %d' % queue.pop(db)
     print 'Next item: %d' % queue.peek(db)
     print 'Pop item: %d' % queue.pop(db)
@@ -259,6 +802,81 @@ def queue_test(db):
     print 'Clear Queue'
     queue.clear(db)
     print 'Empty? %s' % queue.empty(db)
+    print 'Push 4, 3'
+    queue.push(db, 4)
+    queue.push(db, 3)
+    leased = queue.lease(db, 1, 0)
+    print 'Leased item: %d' % leased[0][1]
+    print 'Next item: %d' % queue.peek(db)
+    print 'Swept %d expired leases' % queue.sweepExpired(db)
+    print 'Next item: %d' % queue.peek(db)
+    leased = queue.lease(db, 2, 60)
+    print 'Leased items: %s' % [v for _, v in leased]
+    print 'Stats: %s' % queue.stats(db)
+    print 'Acked %d leases' % queue.ack(db, [i for i, _ in leased])
+    print 'Swept %d expired leases' % queue.sweepExpired(db)
+    print 'Empty? %s' % queue.empty(db)
+    print 'Push 2, then lose the counts'
+    queue.push(db, 2)
+    del db[queue._count.range()]
+    queue.recount(db)
+    print 'Stats: %s' % queue.stats(db)
+
+def queue_large_item_test(db):
+    queue = Queue(fdb.directory.create_or_open(db, ('tests','queue')), True)
+    print 'Clear Queue'
+    queue.clear(db)
+    print 'Push 1MB item, small item'
+    queue.push(db, 'x' * 1000000)
+    queue.push(db, 'small')
+    print 'Pop item of length %d' % len(queue.pop(db))
+    print 'Pop item: %s' % queue.pop(db)
+    print 'Empty? %s' % queue.empty(db)
+
+def queue_delayed_test(db):
+    queue = Queue(fdb.directory.create_or_open(db, ('tests','queue')), False)
+    print 'Clear Queue'
+    queue.clear(db)
+    print 'Push 1 in 1 second, 2 now'
+    queue.push(db, 1, time.time() + 1)
+    queue.push(db, 2)
+    print 'Pop item: %s' % queue.pop(db)
+    print 'Pop item: %s' % queue.pop(db)
+    time.sleep(1)
+    print 'Pop item: %s' % queue.pop(db)
+    print 'Empty? %s' % queue.empty(db)
+
+def queue_log_test(db):
+    queue = Queue(fdb.directory.create_or_open(db, ('tests','queue')), log=True)
+    print 'Clear Queue'
+    queue.clear(db)
+    queue.subscribe(db, 'a')
+    queue.subscribe(db, 'b')
+    print 'Push 1, 2, 3'
+    for i in (1, 2, 3):
+        queue.push(db, i)
+    assert queue.consumeGroup(db, 'a', 2) == [1, 2]
+    assert queue.consumeGroup(db, 'b', 3) == [1, 2, 3]
+    assert queue.trim(db) == 2
+    assert queue.consumeGroup(db, 'a') == [3]
+    assert queue.consumeGroup(db, 'b') == []
+    queue.seekGroup(db, 'b')
+    assert queue.consumeGroup(db, 'b') == [3]
+    print 'Trim to empty, then push 4'
+    assert queue.trim(db) == 1
+    assert queue.empty(db)
+    queue.push(db, 4)
+    assert queue.consumeGroup(db, 'a') == [4]
+    assert queue.consumeGroup(db, 'b') == [4]
+    assert queue.trim(db) == 1
+    print 'Push 5 in 1 second'
+    queue.push(db, 5, time.time() + 1)
+    assert queue.consumeGroup(db, 'a') == []
+    time.sleep(1)
+    assert queue.consumeGroup(db, 'a') == [5]
+    assert queue.consumeGroup(db, 'b') == [5]
+    assert queue.trim(db) == 1
+    assert queue.empty(db)
 
 ######################
 # Queue sample usage #
@@ -285,8 +903,6 @@ def pop_thread(queue, db, id, num):
 
     print 'Finished pop thread %d' % id
 
-import threading
-
 def queue_multi_client_example(db):
     descriptions = ["simple queue", "high contention queue"]
 
@@ -308,6 +924,42 @@ def queue_multi_client_example(db):
         end = time.time()
         print 'Finished %s in %f seconds' % (descriptions[highContention], end - start)
 
+# Measures pops per second in high contention mode as the number of popping
+# clients grows. The queue is filled before popping starts so that the pop
+# rate is not limited by the pushers.
+def queue_pop_scaling_example(db, clientCounts=(1, 2, 5, 10, 20, 50), popsPerClient=50):
+    queue = Queue(fdb.directory.create_or_open(db, ('tests','queue')), True)
+
+    for clients in clientCounts:
+        queue.clear(db)
+        for i in range(clients):
+            push_thread(queue, db, i, popsPerClient)
+
+        popThreads = [ threading.Thread(target=pop_thread, args=(queue, db, i, popsPerClient)) for i in range(clients) ]
+
+        start = time.time()
+        for pop in popThreads: pop.start()
+        for pop in popThreads: pop.join()
+        end = time.time()
+
+        print '%d clients: %f pops/second (fulfill batch %d)' % (clients, clients * popsPerClient / (end - start), queue._fulfillBatch)
+
+def queue_auto_contention_example(db):
+    print 'Starting automatic contention test'
+    queue = Queue(fdb.directory.create_or_open(db, ('tests','queue')), 'auto')
+    queue.clear(db)
+
+    for clients in (1, 10, 1):
+        pushThreads = [ threading.Thread(target=push_thread, args=(queue, db, i, 100)) for i in range(clients) ]
+        popThreads = [ threading.Thread(target=pop_thread, args=(queue, db, i, 100)) for i in range(clients) ]
+
+        for push in pushThreads: push.start()
+        for pop in popThreads: pop.start()
+        for push in pushThreads: push.join()
+        for pop in popThreads: pop.join()
+
+        print '%d clients: %s' % (clients, queue.contentionStats())
+
 def queue_example(db):
     print "Running single client example:"
     queue_single_client_example(db)
@@ -0,0 +1,206 @@
+"""FoundationDB Queue Benchmark.
+
+Measures the throughput and latency of the Queue layer.
+
+A run pushes a fixed number of items from a number of producer threads while
+consumer threads pop them, either one at a time with pop() or in batches with
+lease() and ack(). Each item carries the time it was pushed, so the latency
+from enqueue to dequeue is measured for every item.
+
+Runs are swept over producer and consumer counts, item sizes, batch sizes and
+both contention modes. Leases don't use the contention modes, so batched runs
+are made once and recorded with a highContention of None. Each run's result
+is written as one line of JSON, so results from different versions of the
+layer can be compared.
+"""
+
+import json
+import struct
+import sys
+import threading
+import time
+
+import fdb
+
+import queue
+
+fdb.api_version(200)
+
+#############
+# Benchmark #
+#############
+
+class _Counters(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pushed = 0
+        self.popped = 0
+        self.pushConflicts = 0
+        self.popConflicts = 0
+        self.latencies = []
+
+def _push(db, q, value, counters):
+    tr = db.create_transaction()
+    while 1:
+        try:
+            q.push(tr, value)
+            tr.commit().wait()
+            return
+        except fdb.FDBError as e:
+            if e.code == 1020:
+                with counters.lock:
+                    counters.pushConflicts += 1
+            tr.on_error(e.code).wait()
+
+def _lease(db, q, n, counters):
+    tr = db.create_transaction()
+    while 1:
+        try:
+            leased = q.lease(tr, n, 60)
+            tr.commit().wait()
+            return leased
+        except fdb.FDBError as e:
+            if e.code == 1020:
+                with counters.lock:
+                    counters.popConflicts += 1
+            tr.on_error(e.code).wait()
+
+def _producer(db, q, items, itemSize, counters):
+    padding = 'x' * max(0, itemSize - 8)
+    for i in range(items):
+        _push(db, q, struct.pack('<d', time.time()) + padding, counters)
+        with counters.lock:
+            counters.pushed += 1
+
+def _consumer(db, q, total, batchSize, deadline, counters):
+    while time.time() < deadline:
+        with counters.lock:
+            if counters.popped >= total:
+                return
+
+        if batchSize == 1:
+            value = q.pop(db)
+            values = [] if value is None else [value]
+        else:
+            leased = _lease(db, q, batchSize, counters)
+            q.ack(db, [leaseID for leaseID, _ in leased])
+            values = [value for _, value in leased]
+
+        now = time.time()
+        with counters.lock:
+            counters.popped += len(values)
+            counters.latencies.extend(now - struct.unpack('<d', v[:8])[0] for v in values)
+
+        if not values:
+            time.sleep(0.001)
+
+# Buckets latencies by powers of two milliseconds. The bucket with upper bound
+# b holds latencies in [b/2, b) ms.
+def _histogram(latencies):
+    histogram = {}
+    for latency in latencies:
+        bound = 1
+        while bound <= latency * 1000:
+            bound *= 2
+        histogram[bound] = histogram.get(bound, 0) + 1
+    return dict((str(b), c) for b, c in histogram.items())
+
+def _percentile(sortedValues, p):
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(p * len(sortedValues)))]
+
+def run_benchmark(db, producers, consumers, itemSize, batchSize, highContention, items=1000, timeout=300):
+    """
+    Run one benchmark and return its result as a dictionary.
+
+    items are pushed in total, split evenly between the producers.
+    highContention only applies when batchSize is 1, since batches are leased
+    rather than popped, and is recorded as None otherwise.
+    """
+    q = queue.Queue(fdb.directory.create_or_open(db, ('tests','queuebench')), highContention)
+    q.clear(db)
+
+    counters = _Counters()
+    perProducer = items // producers
+    total = perProducer * producers
+    deadline = time.time() + timeout
+
+    threads = [threading.Thread(target=_producer, args=(db, q, perProducer, itemSize, counters))
+               for i in range(producers)]
+    threads += [threading.Thread(target=_consumer, args=(db, q, total, batchSize, deadline, counters))
+                for i in range(consumers)]
+
+    start = time.time()
+    for t in threads: t.start()
+    for t in threads[:producers]: t.join()
+    pushEnd = time.time()
+    for t in threads[producers:]: t.join()
+    end = time.time()
+
+    contention = q.contentionStats()
+    latencies = sorted(counters.latencies)
+    r = q._conflictedPop.range()
+    leftover = len(list(db.get_range(r.start, r.stop)))
+
+    return {
+        'time': start,
+        'producers': producers,
+        'consumers': consumers,
+        'itemSize': itemSize,
+        'batchSize': batchSize,
+        'highContention': highContention if batchSize == 1 else None,
+        'pushed': counters.pushed,
+        'popped': counters.popped,
+        'pushPerSecond': counters.pushed / (pushEnd - start),
+        'popPerSecond': counters.popped / (end - start),
+        'latencyP50': _percentile(latencies, 0.5),
+        'latencyP99': _percentile(latencies, 0.99),
+        'latencyMax': _percentile(latencies, 1.0),
+        'latencyHistogramMs': _histogram(latencies),
+        'pushConflicts': counters.pushConflicts,
+        'popConflicts': counters.popConflicts + contention['conflicts'],
+        'contendedPops': contention['contendedPops'],
+        'leftoverPopRequests': leftover,
+        'queueStats': q.stats(db),
+    }
+
+def sweep(db, out=sys.stdout, producerCounts=(1, 10), consumerCounts=(1, 10),
+          itemSizes=(16, 4096), batchSizes=(1, 10), modes=(False, True), items=1000):
+    """Run a benchmark for every combination of parameters, writing one JSON line per run to out.
+
+    Batch sizes above 1 are only run in the first mode, since they don't
+    depend on it.
+    """
+    for highContention in modes:
+        for producers in producerCounts:
+            for consumers in consumerCounts:
+                for itemSize in itemSizes:
+                    for batchSize in batchSizes:
+                        if batchSize > 1 and highContention != modes[0]:
+                            continue
+                        result = run_benchmark(db, producers, consumers, itemSize,
+                                               batchSize, highContention, items)
+                        out.write(json.dumps(result, sort_keys=True) + '\n')
+                        out.flush()
+
+# caution: modifies the database!
+if __name__ == '__main__':
+    import argparse
+
+    def ints(s):
+        return tuple(int(i) for i in s.split(','))
+
+    parser = argparse.ArgumentParser(description='Benchmark the Queue layer.')
+    parser.add_argument('--producers', type=ints, default=(1, 10))
+    parser.add_argument('--consumers', type=ints, default=(1, 10))
+    parser.add_argument('--item-sizes', type=ints, default=(16, 4096))
+    parser.add_argument('--batch-sizes', type=ints, default=(1, 10))
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--output', default=None, help='file to append results to')
+    args = parser.parse_args()
+
+    db = fdb.open()
+    out = open(args.output, 'a') if args.output else sys.stdout
+    sweep(db, out, args.producers, args.consumers, args.item_sizes,
+          args.batch_sizes, (False, True), args.items)
@@ -0,0 +1,285 @@
+"""FoundationDB Queue Worker Pool.
+
+Provides a QueueWorkerPool() class for consuming a Queue with a pool of
+handlers.
+
+Items are claimed from the queue in batches with Queue.lease(), so that a
+single transaction claims many items. Claimed items are held in a bounded
+local buffer and handed to a thread pool or process pool of handlers. When the
+buffer is full, no more items are claimed until handlers catch up.
+
+An item is acknowledged only after its handler has returned, and the
+acknowledgements of many items are committed together. If a handler raises
+an exception, or the process dies, the item's lease expires and the item is
+returned to the queue, so items are processed at least once. A handler that
+fails without returning, or has not returned by the time its lease expires,
+is counted as failed and its buffer slot is freed, so the pool never waits on
+it.
+"""
+
+import collections
+import multiprocessing
+import multiprocessing.pool
+import sys
+import threading
+import time
+
+import fdb
+
+import queue
+
+fdb.api_version(200)
+
+###################
+# QueueWorkerPool #
+###################
+
+# Runs in the handler pool. It has to be at module level so that it can be
+# sent to a process pool.
+def _runHandler(handler, leaseID, value):
+    start = time.time()
+    try:
+        handler(value)
+        error = None
+    except:
+        error = repr(sys.exc_info()[1])
+    return leaseID, error, time.time() - start
+
+class QueueWorkerPool(object):
+    """Processes the items of a Queue with a pool of handler threads or processes."""
+
+    def __init__(self, db, queue, handler, workers=4, bufferSize=100,
+                 batchSize=10, leaseTimeout=30, processes=False, pollInterval=0.1):
+        """
+        Create a pool that calls handler(value) for each item of queue.
+
+        At most bufferSize items are claimed but not yet processed at any time.
+        Items are claimed batchSize at a time and leased for leaseTimeout
+        seconds, which should be longer than a handler takes to run. If
+        processes is True, handlers run in a process pool, in which case
+        handler must be picklable.
+        """
+        self.db = db
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.bufferSize = bufferSize
+        self.batchSize = batchSize
+        self.leaseTimeout = leaseTimeout
+        self.processes = processes
+        self.pollInterval = pollInterval
+
+        self._lock = threading.Condition()
+        self._buffered = 0
+        self._completed = []
+        # The result of each buffered item's handler and the time its lease
+        # expires, by leaseID
+        self._running = {}
+        self._stopping = False
+        self._pool = None
+        self._claimThread = None
+
+        self._started = None
+        self._processed = 0
+        self._failed = 0
+        self._errors = collections.deque(maxlen=100)
+        self._latencies = collections.deque(maxlen=1000)
+        self._occupancy = collections.deque(maxlen=1000)
+
+    def start(self):
+        """Start claiming and processing items."""
+        if self.processes:
+            self._pool = multiprocessing.Pool(self.workers)
+        else:
+            self._pool = multiprocessing.pool.ThreadPool(self.workers)
+
+        self._started = time.time()
+        self._stopping = False
+        self._claimThread = threading.Thread(target=self._claimLoop)
+        self._claimThread.daemon = True
+        self._claimThread.start()
+
+    def stop(self):
+        """Stop claiming items, wait for buffered items to be processed and acknowledged, and shut down the pool."""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+
+        self._claimThread.join()
+        self._pool.close()
+        self._pool.join()
+
+    def stats(self):
+        """
+        Get processing statistics.
+
+        Returns a dictionary with the number of items processed and failed,
+        the processing rate in items per second, the mean and maximum handler
+        latency in seconds over recent items, the current and mean occupancy
+        of the local buffer, and the most recent failures as (leaseID, error)
+        pairs.
+        """
+        with self._lock:
+            elapsed = time.time() - self._started if self._started else 0
+            latencies = list(self._latencies)
+            occupancy = list(self._occupancy)
+            return {
+                'processed': self._processed,
+                'failed': self._failed,
+                'itemsPerSecond': self._processed / elapsed if elapsed else 0.0,
+                'meanLatency': sum(latencies) / len(latencies) if latencies else 0.0,
+                'maxLatency': max(latencies) if latencies else 0.0,
+                'buffered': self._buffered,
+                'meanBuffered': float(sum(occupancy)) / len(occupancy) if occupancy else 0.0,
+                'recentErrors': list(self._errors),
+            }
+
+    # Private functions
+
+    def _handled(self, result):
+        leaseID, error, latency = result
+        with self._lock:
+            if self._running.pop(leaseID, None) is None:
+                # Already given up on by _reap()
+                return
+            self._buffered -= 1
+            self._latencies.append(latency)
+            if error is None:
+                self._processed += 1
+                self._completed.append(leaseID)
+            else:
+                self._fail(leaseID, error)
+            self._lock.notify_all()
+
+    # Leaves the item leased, so that it is redelivered once its lease expires.
+    # Must be called with the lock held.
+    def _fail(self, leaseID, error):
+        self._failed += 1
+        self._errors.append((leaseID, error))
+
+    # Frees the buffer slots of handlers that failed without returning a
+    # result, which the pool reports without calling _handled(), and of
+    # handlers still running after their lease has expired, whose items may
+    # already have been redelivered. Must be called with the lock held.
+    def _reap(self):
+        now = time.time()
+        for leaseID, (result, expiry) in self._running.items():
+            if result.ready():
+                if result.successful():
+                    continue
+                try:
+                    result.get()
+                except:
+                    error = repr(sys.exc_info()[1])
+            elif now > expiry:
+                error = 'lease expired before the handler returned'
+            else:
+                continue
+            del self._running[leaseID]
+            self._buffered -= 1
+            self._fail(leaseID, error)
+
+    def _ack(self):
+        with self._lock:
+            completed, self._completed = self._completed, []
+        if completed:
+            self.queue.ack(self.db, completed)
+
+    # Claims batches of items while there is room in the buffer, and commits
+    # acknowledgements for the items that have been processed in between.
+    def _claimLoop(self):
+        while 1:
+            with self._lock:
+                self._reap()
+                while not self._stopping and self.bufferSize - self._buffered < self.batchSize and not self._completed:
+                    self._lock.wait(self.pollInterval)
+                    self._reap()
+                stopping = self._stopping
+                room = self.bufferSize - self._buffered
+                self._occupancy.append(self._buffered)
+
+            self._ack()
+
+            if stopping:
+                with self._lock:
+                    self._reap()
+                    while self._buffered:
+                        self._lock.wait(self.pollInterval)
+                        self._reap()
+                self._ack()
+                return
+
+            if room < self.batchSize:
+                continue
+
+            leased = self.queue.lease(self.db, self.batchSize, self.leaseTimeout)
+            if not leased:
+                # Return items whose handlers died to the queue while idle
+                if not self.queue.sweepExpired(self.db):
+                    time.sleep(self.pollInterval)
+                continue
+
+            expiry = time.time() + self.leaseTimeout
+            with self._lock:
+                self._buffered += len(leased)
+                for leaseID, value in leased:
+                    self._running[leaseID] = (
+                        self._pool.apply_async(_runHandler, (self.handler, leaseID, value),
+                                               callback=self._handled),
+                        expiry)
+
+##################
+# Internal tests #
+##################
+
+def print_handler(value):
+    print 'Handled %s' % value
+
+# caution: modifies the database!
+def worker_pool_example(db):
+    q = queue.Queue(fdb.directory.create_or_open(db, ('tests','queue')), False)
+    q.clear(db)
+
+    for i in range(100):
+        q.push(db, i)
+
+    pool = QueueWorkerPool(db, q, print_handler, workers=8, bufferSize=32, batchSize=8)
+    pool.start()
+    while not q.empty(db):
+        time.sleep(0.1)
+    pool.stop()
+
+    print pool.stats()
+    print q.stats(db)
+
+def failing_handler(value):
+    if value % 3 == 1:
+        raise ValueError(value)
+    if value % 3 == 2:
+        # Not an Exception, so it used to escape the handler wrapper
+        raise SystemExit(value)
+
+# caution: modifies the database!
+def worker_pool_failure_example(db):
+    q = queue.Queue(fdb.directory.create_or_open(db, ('tests','queue')), False)
+    q.clear(db)
+
+    for i in range(30):
+        q.push(db, i)
+
+    pool = QueueWorkerPool(db, q, failing_handler, workers=4, bufferSize=16, batchSize=4,
+                           leaseTimeout=1)
+    pool.start()
+    while pool.stats()['processed'] < 10:
+        time.sleep(0.1)
+    # Returns although most items failed
+    pool.stop()
+
+    stats = pool.stats()
+    assert stats['failed'] >= 20 and stats['buffered'] == 0
+    print stats['recentErrors'][:3]
+
+if __name__ == '__main__':
+    db = fdb.open()
+    worker_pool_example(db)
+    worker_pool_failure_example(db)
@@ -5,10 +5,43 @@ Provides a RankedSet class.
 Ranked sets support efficient retrieval of elements by their rank as defined by
 lexiographic order. Elements are inserted into (or removed from) the set by key.
 The rank of any element can then be quickly determined, and an element can be
-quickly retrieved by based on its rank.
+quickly retrieved by based on its rank. The number of keys in a range, and the
+keys at given quantiles, are found the same way, without reading the keys in
+between.
+
+iter_by_rank() pages through the set by position, seeking to the first rank
+once and then reading the keys in order, across several transactions if
+necessary.
+
+A large set can be built from sorted keys in a single pass with bulk_load(),
+which writes the levels to a new location and then switches the set to them
+in one transaction.
+
+The number of levels and the fan-out between levels are chosen when a set is
+created and stored with it. estimate_parameters() suggests values for a given
+set size.
+
+Each RankedSet object caches the top levels of its set, which are small and
+read by every rank() and get_nth(). The cache is validated against a version
+key that every change to the set moves. The version is read together with the
+first level below the cache, which is read assuming the cache is current, so
+while the set is unchanged a lookup takes one round trip for each level below
+the cache and no others.
+
+A set opened with low_conflict=True inserts and erases keys with snapshot
+reads, explicit conflict ranges and atomic adds. Every insert changes the count
+of a node at each level, so with serializable reads any two inserts under the
+same node of a sparse top level conflict. In this mode an insert only conflicts
+with changes to the nodes it actually depends on: its predecessor at each
+level, the gap between them, and the nodes it takes over when it splits a node.
 
 """
+import bisect
+import hashlib
+import math
+import os
 import struct
+import threading
 
 import fdb
 import fdb.tuple
@@ -19,6 +52,7 @@ fdb.api_version(200)
 # Ranked Set #
 ##############
 
+# Defaults for new sets
 MAX_LEVELS = 6
 LEVEL_FAN_POW = 4  # 2^X per level
 
@@ -34,113 +68,454 @@ def decodeCount(v):
     return struct.unpack('<q', str(v))[0]
 
 
+def _key_hash(key):
+    return struct.unpack('<Q', hashlib.md5(fdb.tuple.pack((key,))).digest()[:8])[0]
+
+
+def estimate_parameters(size, max_levels=10, max_fan_pow=8, round_trip_rows=50):
+    """
+    Suggests (levels, fan_pow) for a set of about size keys.
+
+    Picks the parameters that minimize the expected cost of a rank or get_nth,
+    counting the rows read plus round_trip_rows for each level visited.
+    Returns (levels, fan_pow, expected rows read).
+    """
+    best = None
+    for fan_pow in range(1, max_fan_pow + 1):
+        for levels in range(1, max_levels + 1):
+            if levels * fan_pow > 64:
+                break
+            # A descent reads about half of the top level, and about half of
+            # the 2^fan_pow nodes under a node at each level below it.
+            top = max(1.0, size / 2.0 ** (fan_pow * (levels - 1)))
+            rows = top / 2 + (levels - 1) * 2 ** fan_pow / 2.0
+            cost = rows + levels * round_trip_rows
+            if best is None or cost < best[0]:
+                best = (cost, levels, fan_pow, rows)
+    return best[1], best[2], int(math.ceil(best[3]))
+
+
 class RankedSet(object):
 
     @fdb.transactional
-    def __init__(self, tr, subspace):
+    def __init__(self, tr, subspace, levels=None, fan_pow=None, cache_levels=2,
+                 low_conflict=False):
+        """
+        Opens the set in subspace, creating it if necessary.
+
+        levels and fan_pow (each level holds about 1 in 2^fan_pow of the keys
+        of the level below) are used when the set is created. An existing set
+        keeps the parameters it was created with. The top cache_levels levels
+        are cached by this object. If low_conflict is True, insert() and erase()
+        by this object avoid conflicting with concurrent changes elsewhere in
+        the set.
+        """
         self.subspace = subspace
+        self._low_conflict = low_conflict
+        # Moved by a random amount by every change, so that a version read
+        # within a transaction with uncommitted changes can't match a version
+        # committed by another client.
+        self._version = self.subspace['V']
+        self._cache_levels = cache_levels
+        # (location, version, {level: [(packed key, key, count)]}), with no
+        # levels until they are first read
+        self._cache = (None, None, None)
+        # Holds the ID of the bulk load whose levels are live, if any.
+        self._location = self.subspace['L']
+        # The last location seen, at which the first reads of an operation are
+        # made before the location is known
+        self._known_location = None
+        # Holds (levels, fan_pow).
+        self._params = self.subspace['P']
+        d, (params, head), _ = self._read_data(
+            tr, lambda d: ([tr[self._params.key()], tr[d.pack((0, ""))]], []))
+        if params == None and head != None:
+            # Created before parameters were stored with the set
+            self._levels, self._fan_pow = MAX_LEVELS, LEVEL_FAN_POW
+        elif params == None:
+            self._levels = levels or MAX_LEVELS
+            self._fan_pow = fan_pow or LEVEL_FAN_POW
+        else:
+            self._levels, self._fan_pow = fdb.tuple.unpack(params)
+        self._cache_levels = min(self._cache_levels, self._levels - 1)
         self._setup_levels(tr)
 
+    # Returns the subspace holding the levels at location. A set that has
+    # never been bulk loaded keeps its levels directly in its own subspace.
+    def _location_subspace(self, location):
+        if location == None:
+            return self.subspace
+        return self.subspace['B'][fdb.tuple.unpack(location)[0]]
+
+    def _data(self, tr):
+        return self._location_subspace(tr[self._location.key()])
+
+    # Issues the reads made by reads(d), which returns (values, ranges) as
+    # taken by _wait(), together with the read of the location key, and waits
+    # on them all at once. The reads are made in the subspace d for the
+    # location this object last saw, so that the location doesn't take a
+    # round trip of its own, and are only made again if it has changed.
+    # Returns (d, values, range results).
+    def _read_data(self, tr, reads):
+        location = tr[self._location.key()]
+        known = self._known_location
+        values, ranges = reads(self._location_subspace(known))
+        results = self._wait([location] + values, ranges)
+        location = None if location == None else str(location)
+        if location != known:
+            self._known_location = location
+            values, ranges = reads(self._location_subspace(location))
+            results = self._wait(values, ranges)
+        return self._location_subspace(location), values, results
+
+    def _bump_version(self, tr):
+        tr.add(self._version.key(), os.urandom(8))
+
+    # Waits for reads that were all issued before any of them is waited on,
+    # which takes a single round trip. values are futures, and ranges are
+    # (level, range) pairs, whose rows are returned as lists.
+    def _wait(self, values, ranges):
+        for v in values:
+            v.present()
+        return [list(r) for _, r in ranges]
+
+    # Groups queries that need the nodes of the next level from the same node
+    # onwards, and so can share one range read. span(q) returns the packed
+    # keys bounding the nodes q needs. Queries at the same node are adjacent,
+    # since they are kept in order.
+    def _groups(self, queries, span):
+        groups = []
+        for q in queries:
+            start, stop = span(q)
+            if groups and groups[-1][0] == start:
+                groups[-1][1] = max(groups[-1][1], stop)
+                groups[-1][2].append(q)
+            else:
+                groups.append([start, stop, [q]])
+        return groups
+
+    # Starts reading the nodes of a level in each of spans, a list of pairs of
+    # packed keys. Returns (nodes, ranges): for a cached level the lists of
+    # (key, count) are returned directly, and otherwise the range reads are
+    # all issued and returned to be waited on together.
+    def _start_level(self, tr, d, cached, level, spans):
+        if level in cached:
+            nodes = cached[level]
+            return [[(k, c) for _, k, c in nodes[bisect.bisect_left(nodes, (start,)):
+                                                  bisect.bisect_left(nodes, (stop,))]]
+                    for start, stop in spans], []
+        prefix = d[level].key()
+        return None, [(level, tr.get_range(prefix + start, prefix + stop,
+                                           streaming_mode=fdb.StreamingMode.want_all))
+                      for start, stop in spans]
+
+    def _level_results(self, d, level, results):
+        lss = d[level]
+        return [[(lss.unpack(k)[0], decodeCount(c)) for k, c in rows] for rows in results]
+
+    # Rereads the cached levels at location, in one round trip.
+    def _refresh_cache(self, tr, location, version):
+        d = self._location_subspace(location)
+        levels = range(self._levels - self._cache_levels, self._levels)
+        results = self._wait([], [(level, tr[d[level].range()]) for level in levels])
+        cached = {}
+        for level, rows in zip(levels, results):
+            cached[level] = [(fdb.tuple.pack((k,)), k, c)
+                             for k, c in self._level_results(d, level, [rows])[0]]
+        self._known_location = location
+        self._cache = (location, version, cached)
+
+    # Runs a batch of descents from the top level to level 0. Each query is a
+    # list starting with the node its descent has reached. At each level, the
+    # queries are grouped by that node and the range reads for all of the
+    # groups are issued before any is waited on, so each level below the
+    # cached ones takes one round trip however many queries there are.
+    # step(level, queries, nodes) processes the nodes read for a group and
+    # returns the queries that need the next level.
+    #
+    # The location and version keys, and the reads issued by extra(d) for the
+    # subspace d holding the levels, aren't waited on by themselves. They are
+    # issued with the reads of the first level that isn't cached, which are
+    # made assuming the cache is current. If it turns out not to be, the
+    # cache is reread and the descent is started again. Returns the futures
+    # issued by extra(d).
+    def _descend(self, tr, queries, span, step, extra=lambda d: []):
+        location = tr[self._location.key()]
+        version = tr[self._version.key()]
+        initial = [list(q) for q in queries]
+        while 1:
+            cacheLocation, cacheVersion, cached = self._cache
+            d = self._location_subspace(cacheLocation)
+            for q, q0 in zip(queries, initial):
+                q[:] = q0
+            values = extra(d)
+            active = queries
+            level = self._levels - 1
+            ranges = []
+            while active and level >= 0:
+                groups = self._groups(active, span)
+                nodes, ranges = self._start_level(tr, d, cached or {}, level, [g[:2] for g in groups])
+                if nodes is None:
+                    break
+                active = [q for g, n in zip(groups, nodes) for q in step(level, g[2], n)]
+                level -= 1
+            results = self._wait([location, version] + values, ranges)
+            current = (None if location == None else str(location),
+                       None if version == None else str(version))
+            if cached is not None and current == (cacheLocation, cacheVersion):
+                break
+            self._refresh_cache(tr, current[0], current[1])
+
+        while ranges:
+            nodes = self._level_results(d, level, results)
+            active = [q for g, n in zip(groups, nodes) for q in step(level, g[2], n)]
+            level -= 1
+            ranges = []
+            if active and level >= 0:
+                groups = self._groups(active, span)
+                _, ranges = self._start_level(tr, d, {}, level, [g[:2] for g in groups])
+                results = self._wait([], ranges)
+        return values
+
+    # A rank query is [node, rank so far, key]. It needs the nodes from its
+    # node up to and including key.
+    def _rank_span(self, q):
+        return fdb.tuple.pack((q[0],)), fdb.tuple.pack((q[2],)) + '\x00'
+
+    def _rank_step(self, level, queries, nodes):
+        packed = [fdb.tuple.pack((k,)) for k, _ in nodes]
+        active = []
+        for q in queries:
+            # The last node up to the key is the one to descend into
+            n = bisect.bisect_right(packed, fdb.tuple.pack((q[2],)))
+            q[1] += sum(c for _, c in nodes[:n - 1])
+            q[0] = nodes[n - 1][0]
+            if q[0] == q[2]:
+                continue
+            if level == 0:
+                # The last level 0 node is the greatest key less than key
+                q[1] += nodes[n - 1][1]
+            else:
+                active.append(q)
+        return active
+
+    # A get_nth query is [node, rank remaining, packed end of the node's
+    # children, result]. It needs the node's children.
+    def _nth_span(self, q):
+        return fdb.tuple.pack((q[0],)), q[2]
+
+    def _nth_step(self, level, queries, nodes):
+        # Ranks in a group are in increasing order, so once one needs
+        # more nodes, so do all of the ones after it.
+        active = []
+        pending = list(queries)
+        consumed = 0
+        for i, (key, count) in enumerate(nodes):
+            while pending:
+                q = pending[0]
+                r = q[1] - consumed
+                if key != "" and r == 0:
+                    q[3] = key
+                elif count > r:
+                    q[0] = key
+                    q[1] = r
+                    if i + 1 < len(nodes):
+                        q[2] = fdb.tuple.pack((nodes[i + 1][0],))
+                    active.append(q)
+                else:
+                    break
+                pending.pop(0)
+            if not pending:
+                break
+            consumed += count
+        return active
+
     @fdb.transactional
     def _slow_count(self, tr, level, begin_key, end_key):
-        if level == -1:
-            if begin_key == "":
-                return 0
-            else:
-                return 1
-        l = tr[self.subspace.pack((level, begin_key)):
-               self.subspace.pack((level, end_key))]
+        d = self._data(tr)
+        l = tr[d.pack((level, begin_key)):
+               d.pack((level, end_key))]
         return sum(decodeCount(kv.value) for kv in l)
 
     @fdb.transactional
     def _setup_levels(self, tr):
-        for l in range(MAX_LEVELS):
-            k = self.subspace.pack((l, ""))
-            if tr[k] == None:
-                tr[k] = encodeCount(0)
+        params = tr[self._params.key()]
+        d = self._data(tr)
+        heads = [tr[d.pack((l, ""))] for l in range(self._levels)]
+        if params == None:
+            tr[self._params.key()] = fdb.tuple.pack((self._levels, self._fan_pow))
+        for l, head in enumerate(heads):
+            if head == None:
+                tr[d.pack((l, ""))] = encodeCount(0)
 
     # returns key, count
     @fdb.transactional
-    def _get_previous_node(self, tr, level, key):
-        k = self.subspace.pack((level, key))
-        #kv = list(tr.snapshot.get_range(fdb.KeySelector.last_less_than(k),
-        kv = list(tr.get_range(fdb.KeySelector.last_less_than(k),
-                               fdb.KeySelector.first_greater_or_equal(k),
-                               limit=1))[0]
-        prevKey = self.subspace.unpack(kv.key)[1]
-        #tr.add_read_conflict_range(kv.key + '\x00', k)
-        #tr.add_read_conflict_key(self.subspace.pack((0, prevKey)))
+    def _get_previous_node(self, tr, level, key, snapshot=False):
+        d = self._data(tr)
+        k = d.pack((level, key))
+        if not snapshot:
+            kv = list(tr.get_range(fdb.KeySelector.last_less_than(k),
+                                   fdb.KeySelector.first_greater_or_equal(k),
+                                   limit=1))[0]
+            return d.unpack(kv.key)[1]
+
+        # Conflict with keys being added to the gap before key and with the
+        # previous key being erased (which clears its level 0 node), but not
+        # with atomic adds to the previous node's count.
+        kv = list(tr.snapshot.get_range(fdb.KeySelector.last_less_than(k),
+                                        fdb.KeySelector.first_greater_or_equal(k),
+                                        limit=1))[0]
+        prevKey = d.unpack(kv.key)[1]
+        tr.add_read_conflict_range(kv.key + '\x00', k)
+        if prevKey != "":
+            tr.add_read_conflict_key(d.pack((0, prevKey)))
         return prevKey
 
+    # Inserts key, which is not in the set.
+    def _insert(self, tr, d, key):
+        self._bump_version(tr)
+        if self._low_conflict:
+            self._insert_low_conflict(tr, d, key)
+            return
+        keyLevels = self._key_levels(key)
+        # The count of a level 0 node is always 1, so a new key doesn't
+        # change its predecessor there.
+        tr[d.pack((0, key))] = encodeCount(1)
+        for level in range(1, self._levels):
+            prevKey = self._get_previous_node(tr, level, key)
+
+            if level not in keyLevels:
+                tr.add(d.pack((level, prevKey)), encodeCount(1))
+            else:
+                # Insert into this level by looking at the count of the previous
+                # key in the level and recounting the next lower level to correct
+                # the counts
+                prevCount = decodeCount(tr[d.pack((level, prevKey))])
+                newPrevCount = self._slow_count(tr, level - 1, prevKey, key)
+                count = prevCount - newPrevCount
+                count += 1
+
+                # "splits", prevKey, "oldC", prevCount, "newC", newPrevCount
+                tr[d.pack((level, prevKey))] = encodeCount(newPrevCount)
+                tr[d.pack((level, key))] = encodeCount(count)
+
+    # Inserts key, which is not in the set, without reading any counts that
+    # concurrent inserts elsewhere in the set change.
+    def _insert_low_conflict(self, tr, d, key):
+        keyLevels = self._key_levels(key)
+        tr[d.pack((0, key))] = encodeCount(1)
+        for level in range(1, self._levels):
+            prevKey = self._get_previous_node(tr, level, key, snapshot=True)
+
+            if level not in keyLevels:
+                tr.add(d.pack((level, prevKey)), encodeCount(1))
+                continue
+
+            # key takes over the nodes of the level below from key up to the
+            # next node in this level, which all counted towards prevKey.
+            lss = d[level]
+            below = d[level - 1]
+            nextNode = list(tr.snapshot.get_range(fdb.KeySelector.first_greater_than(lss.pack((key,))),
+                                                  lss.range().stop, limit=1))
+            if nextNode:
+                end = below.pack((lss.unpack(nextNode[0].key)[0],))
+                conflictEnd = end + '\x00'
+            else:
+                end = conflictEnd = below.range().stop
+            count = sum(decodeCount(c) for _, c in tr.snapshot[below.pack((key,)):end])
+            tr.add_read_conflict_range(below.pack((key,)), conflictEnd)
+
+            # All but the new key were counted by prevKey
+            tr.add(d.pack((level, prevKey)), encodeCount(1 - count))
+            tr[d.pack((level, key))] = encodeCount(count)
+
     @fdb.transactional
     def _debug_print(self, tr, func=lambda x: x):
-        for l in range(MAX_LEVELS):
+        d = self._data(tr)
+        for l in range(self._levels):
             print "\nlevel", l, ":"
-            for k, c in tr[self.subspace.range((l,))]:
-                t = self.subspace.unpack(k)
+            for k, c in tr[d.range((l,))]:
+                t = d.unpack(k)
                 print "\t", func(t[1]), "=", decodeCount(c)
 
+    # Returns the levels key belongs to. Every key is in level 0, and a key is
+    # in each level above that its hash selects. The hash is computed from the
+    # key's encoding, so every client agrees on it.
+    def _key_levels(self, key):
+        keyHash = _key_hash(key)
+        return [level for level in range(self._levels)
+                if not keyHash & (2 ** (level * self._fan_pow) - 1)]
+
+    @fdb.transactional
+    def _write_rows(self, tr, rows):
+        for k, v in rows:
+            tr[k] = v
+
+    @fdb.transactional
+    def _switch_location(self, tr, loadID):
+        if tr[self._location.key()] == fdb.tuple.pack((loadID,)):
+            # An earlier attempt committed, but its result was unknown
+            return
+        old = self._data(tr)
+        tr[self._location.key()] = fdb.tuple.pack((loadID,))
+        self._bump_version(tr)
+        # Clear the levels that are no longer live, wherever they were.
+        for l in range(self._levels):
+            del tr[self.subspace.range((l,))]
+        if old.key() != self.subspace.key():
+            del tr[old.range()]
+
     # public interface ############
 
     @fdb.transactional
     def size(self, tr):
         """ Returns the number of items in the set. """
-        return sum(decodeCount(kv.value) for kv in tr[self.subspace[MAX_LEVELS - 1].range()])
+        top = self._levels - 1
+        _, _, (rows,) = self._read_data(tr, lambda d: ([], [(top, tr[d[top].range()])]))
+        return sum(decodeCount(kv.value) for kv in rows)
 
     @fdb.transactional
     def insert(self, tr, key):
         """ Inserts an item into the set. No effect if item is already present. """
         if key == "":
             raise Exception("Empty key not allowed in set")
-        if self.contains(tr, key):
+        d, (c,), _ = self._read_data(tr, lambda d: ([tr[d.pack((0, key))]], []))
+        if c != None:
             return
-        level = 0
-        keyHash = hash(key)
-        for level in range(MAX_LEVELS):
-            prevKey = self._get_previous_node(tr, level, key)
-
-            if keyHash & (2 ** (level * LEVEL_FAN_POW) - 1):
-                tr.add(self.subspace.pack((level, prevKey)), encodeCount(1))
-            else:
-                # Insert into this level by looking at the count of the previous
-                # key in the level and recounting the next lower level to correct
-                # the counts
-                prevCount = decodeCount(tr[self.subspace.pack((level, prevKey))])
-                newPrevCount = self._slow_count(tr, level - 1, prevKey, key)
-                count = prevCount - newPrevCount
-                count += 1
-
-                # "splits", prevKey, "oldC", prevCount, "newC", newPrevCount
-                tr[self.subspace.pack((level, prevKey))] = encodeCount(newPrevCount)
-                tr[self.subspace.pack((level, key))] = encodeCount(count)
+        self._insert(tr, d, key)
 
     @fdb.transactional
     def contains(self, tr, key):
         """ Checks for the presense of an item in the set. """
         if key == "":
             raise Exception("Empty key not allowed in set")
-        return tr[self.subspace.pack((0, key))] != None
+        _, (c,), _ = self._read_data(tr, lambda d: ([tr[d.pack((0, key))]], []))
+        return c != None
 
     @fdb.transactional
     def erase(self, tr, key):
         """ Removes an item from the set. No effect if item is already not present. """
-        if not self.contains(tr, key):
+        if key == "":
+            raise Exception("Empty key not allowed in set")
+        d, (c,), _ = self._read_data(tr, lambda d: ([tr[d.pack((0, key))]], []))
+        if c == None:
             return
-        for level in range(MAX_LEVELS):
+        self._bump_version(tr)
+        for level in range(self._levels):
             # This could be optimized with hash
-            k = self.subspace.pack((level, key))
+            k = d.pack((level, key))
             c = tr[k]
             if c != None:
                 del tr[k]
             if level == 0:
                 continue
 
-            prevKey = self._get_previous_node(tr, level, key)
+            prevKey = self._get_previous_node(tr, level, key, self._low_conflict)
             assert prevKey != key
             countChange = -1
             if c != None:
                 countChange += decodeCount(c)
-            tr.add(self.subspace.pack((level, prevKey)),
+            tr.add(d.pack((level, prevKey)),
                    encodeCount(countChange))
 
     @fdb.transactional
@@ -149,23 +524,7 @@ class RankedSet(object):
         Returns the (0-based) index of the lexicographically-ordered items in the set.
         Returns None if the item is not in the set.
         """
-        if key == "":
-            raise Exception("Empty key not allowed in set")
-        if not self.contains(tr, key):
-            return None
-        r = 0
-        rank_key = ""
-        for level in range(MAX_LEVELS - 1, -1, -1):
-            lss = self.subspace[level]
-            lastCount = 0
-            for k, c in tr[lss.pack((rank_key,)): fdb.KeySelector.first_greater_than(lss.pack((key,)))]:
-                rank_key = lss.unpack(k)[0]
-                lastCount = decodeCount(c)
-                r += lastCount
-            r -= lastCount
-            if rank_key == key:
-                break
-        return r
+        return self.rank_many(tr, [key])[0]
 
     @fdb.transactional
     def get_nth(self, tr, rank):
@@ -173,22 +532,132 @@ class RankedSet(object):
         Returns the Nth lexicographically-ordered item in the set (0-based indexing).
         Returns None if the rank is out of bounds.
         """
-        if rank < 0:
+        return self.get_nth_many(tr, [rank])[0]
+
+    @fdb.transactional
+    def rank_many(self, tr, keys):
+        """
+        Returns a list of the ranks of keys, as rank() would, in the same order.
+
+        All of the keys descend the levels together. Keys whose descent
+        reaches a level at the same node share one range read, and the reads
+        for a level are all issued before any is waited on, so each level takes
+        one round trip however many keys there are.
+        """
+        for key in keys:
+            if key == "":
+                raise Exception("Empty key not allowed in set")
+        queries = {}
+        for key in keys:
+            queries.setdefault(fdb.tuple.pack((key,)), ["", 0, key])
+        order = sorted(queries)
+        # Whether each key is present is read along with the first level read
+        present = self._descend(tr, [queries[k] for k in order],
+                                self._rank_span, self._rank_step,
+                                lambda d: [tr[d.pack((0, queries[k][2]))] for k in order])
+        found = set(k for k, p in zip(order, present) if p != None)
+
+        return [queries[k][1] if k in found else None
+                for k in (fdb.tuple.pack((key,)) for key in keys)]
+
+    @fdb.transactional
+    def get_nth_many(self, tr, ranks):
+        """
+        Returns a list of the items at ranks, as get_nth() would, in the same
+        order.
+
+        All of the ranks descend the levels together, sharing range reads in
+        the same way as rank_many().
+        """
+        queries = dict((rank, ["", rank, '\xff', None]) for rank in ranks if rank >= 0)
+        self._descend(tr, [queries[rank] for rank in sorted(queries)],
+                      self._nth_span, self._nth_step)
+
+        return [queries[rank][3] if rank in queries else None for rank in ranks]
+
+    @fdb.transactional
+    def count_range(self, tr, start_key, end_key):
+        """
+        Returns the number of keys in the range [start_key, end_key), without
+        reading the keys themselves.
+        """
+        # Rank queries give the number of keys less than their key, whether or
+        # not it is in the set.
+        start = ["", 0, start_key]
+        end = ["", 0, end_key]
+        queries = sorted([start, end], key=lambda q: fdb.tuple.pack((q[2],)))
+        self._descend(tr, queries, self._rank_span, self._rank_step)
+        return max(0, end[1] - start[1])
+
+    # Returns the rank of quantile q in a set of size keys
+    def _quantile_rank(self, q, size):
+        if not 0 <= q <= 1:
+            raise Exception("Quantile must be between 0 and 1")
+        return int(q * (size - 1))
+
+    @fdb.transactional
+    def quantile(self, tr, q):
+        """
+        Returns the key at quantile q (between 0 and 1) of the set, the key
+        with rank int(q * (size - 1)). Returns None if the set is empty.
+        """
+        size = self.size(tr)
+        rank = self._quantile_rank(q, size)
+        if not size:
             return None
-        r = rank
-        key = ""
-        for level in range(MAX_LEVELS - 1, -1, -1):
-            lss = self.subspace[level]
-            for k, c in tr[lss[key]: lss.range().stop]:
-                key = lss.unpack(k)[0]
-                count = decodeCount(c)
-                if key != "" and r == 0:
-                    return key
-                if count > r:
-                    break
-                r -= count
-            else:
-                return None
+        return self.get_nth(tr, rank)
+
+    @fdb.transactional
+    def quantiles(self, tr, qs):
+        """ Returns a list of the keys at each quantile in qs, as quantile() would. """
+        size = self.size(tr)
+        ranks = [self._quantile_rank(q, size) for q in qs]
+        if not size:
+            return [None] * len(qs)
+        return self.get_nth_many(tr, ranks)
+
+    # Returns up to limit keys, starting at the key with start_rank, or after
+    # after_key if it is given.
+    @fdb.transactional
+    def _rank_batch(self, tr, start_rank, after_key, limit):
+        if after_key is None:
+            key = self.get_nth(tr, start_rank)
+            if key == None:
+                return []
+            level0 = self._data(tr)[0]
+            return [level0.unpack(k)[0]
+                    for k, v in tr.get_range(level0.pack((key,)), level0.range().stop, limit=limit)]
+
+        def reads(d):
+            begin = fdb.KeySelector.first_greater_than(d[0].pack((after_key,)))
+            return [], [(0, tr.get_range(begin, d[0].range().stop, limit=limit))]
+        d, _, (rows,) = self._read_data(tr, reads)
+        return [d[0].unpack(k)[0] for k, v in rows]
+
+    def iter_by_rank(self, db_or_tr, start_rank, stop_rank=None, batch_size=1000):
+        """
+        Generates the keys with ranks in [start_rank, stop_rank), or from
+        start_rank to the end of the set if stop_rank is None.
+
+        Seeks to start_rank once, then reads the keys in order in batches of
+        batch_size. Given a transaction, every batch is read in it. Given a
+        database, each batch is read in its own transaction, continuing after
+        the last key read, so ranges too large for one transaction can be
+        read. In that case keys inserted or erased concurrently may or may not
+        be generated.
+        """
+        remaining = None if stop_rank is None else stop_rank - start_rank
+        last = None
+        while remaining is None or remaining > 0:
+            limit = batch_size if remaining is None else min(batch_size, remaining)
+            keys = self._rank_batch(db_or_tr, start_rank, last, limit)
+            for key in keys:
+                yield key
+            if len(keys) < limit:
+                return
+            last = keys[-1]
+            if remaining is not None:
+                remaining -= len(keys)
 
     @fdb.transactional
     def get_range(self, tr, start_key, end_key):
@@ -198,24 +667,107 @@ class RankedSet(object):
         """
         if start_key == "":
             raise Exception("Empty key not allowed in set")
-        return [self.subspace.unpack(k)[-1]
-                for k, v in
-                tr[self.subspace.pack((0, start_key)):
-                    self.subspace.pack((0, end_key))]]
+        d, _, (rows,) = self._read_data(
+            tr, lambda d: ([], [(0, tr[d.pack((0, start_key)):d.pack((0, end_key))])]))
+        return [d.unpack(k)[-1] for k, v in rows]
 
     @fdb.transactional
     def clear_all(self, tr):
         """ Clears the entire set. """
         del tr[self.subspace.range()]
+        self._bump_version(tr)
         self._setup_levels(tr)
 
+    def bulk_load(self, db, sorted_keys, batch_bytes=1000000, parallelism=8):
+        """
+        Replaces the contents of the set with sorted_keys, which must be in
+        strictly increasing order.
+
+        The levels are computed in a single pass over the keys and written to a
+        new location in transactions of about batch_bytes each, up to
+        parallelism at a time. The new levels then replace the old ones in one
+        transaction, so readers see either the old set or the new one.
+        Concurrent inserts and erases made during the load are discarded.
+        """
+        loadID = os.urandom(16)
+        target = self.subspace['B'][loadID]
+
+        threads = []
+        errors = []
+        def write(rows):
+            try:
+                self._write_rows(db, rows)
+            except Exception as e:
+                errors.append(e)
+
+        def flush(rows):
+            while len([t for t in threads if t.is_alive()]) >= parallelism:
+                threads[0].join()
+                threads[:] = [t for t in threads if t.is_alive()]
+            t = threading.Thread(target=write, args=(rows,))
+            t.start()
+            threads.append(t)
+
+        try:
+            self._load_levels(sorted_keys, target, batch_bytes, flush)
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+        except:
+            # Wait for the writes in flight, so that none lands after the
+            # partly written levels are cleared.
+            for t in threads:
+                t.join()
+            del db[target.range()]
+            raise
+
+        self._switch_location(db, loadID)
+
+    # Computes the levels for sorted_keys in a single pass and passes them to
+    # flush() in batches of about batch_bytes.
+    def _load_levels(self, sorted_keys, target, batch_bytes, flush):
+        # The open node of each level and the number of keys it covers so far.
+        # Every level starts with the empty sentinel key.
+        nodes = [""] * self._levels
+        counts = [0] * self._levels
+        rows = []
+        size = 0
+        last = None
+        for key in sorted_keys:
+            if key == "":
+                raise Exception("Empty key not allowed in set")
+            packed = fdb.tuple.pack((key,))
+            if last is not None and packed <= last:
+                raise Exception("Keys must be in strictly increasing order")
+            last = packed
+
+            keyLevels = self._key_levels(key)
+            for level in range(self._levels):
+                if level in keyLevels:
+                    row = (target.pack((level, nodes[level])), encodeCount(counts[level]))
+                    rows.append(row)
+                    size += len(row[0]) + len(row[1])
+                    nodes[level] = key
+                    counts[level] = 1
+                else:
+                    counts[level] += 1
+
+            if size >= batch_bytes:
+                flush(rows)
+                rows = []
+                size = 0
+
+        for level in range(self._levels):
+            rows.append((target.pack((level, nodes[level])), encodeCount(counts[level])))
+        flush(rows)
+
 ##################
 # Internal tests #
 ##################
 
-import os
 import random
-import threading
+import time
 
 #fdb.impl.TransactionRead.create_transaction = lambda self: self
 #fdb.impl.TransactionRead.commit = lambda self: self.db.create_transaction().commit()
@@ -244,17 +796,145 @@ def rankedSetOp(tr, rs):
         k = rs.get_nth(tr, r)
         r2 = rs.rank(tr, k)
         r3 = len(rs.get_range(tr, "\x00", k))
+        r4 = rs.count_range(tr, "\x00", k)
         with excl:
-            if not (r == r2 == r3):
-                print [k], r, r2, r3
+            if not (r == r2 == r3 == r4):
+                print [k], r, r2, r3, r4
                 rs._debug_print(tr, lambda x: [x])
-        assert r == r2 == r3
+        assert r == r2 == r3 == r4
 
 
 def rankedSetTest(db, rs):
     for _ in range(1000):
         rankedSetOp(db, rs)
 
+def bulkLoadTest(db, rs, n=10000):
+    keys = sorted(set(os.urandom(8) for _ in range(n)))
+    rs.bulk_load(db, keys, batch_bytes=10000)
+    assert rs.size(db) == len(keys)
+    for _ in range(100):
+        r = random.randint(0, len(keys) - 1)
+        assert rs.get_nth(db, r) == keys[r]
+        assert rs.rank(db, keys[r]) == r
+    ranks = [random.randint(-1, len(keys)) for _ in range(100)]
+    nth = rs.get_nth_many(db, ranks)
+    assert nth == [keys[r] if 0 <= r < len(keys) else None for r in ranks]
+    assert rs.rank_many(db, [k for k in nth if k is not None]) == [n for n in ranks if 0 <= n < len(keys)]
+    assert rs.rank_many(db, ["\xff" * 9]) == [None]
+    for _ in range(100):
+        a, b = sorted(os.urandom(8) for _ in range(2))
+        assert rs.count_range(db, a, b) == bisect.bisect_left(keys, b) - bisect.bisect_left(keys, a)
+    qs = [0, 0.01, 0.5, 0.99, 1]
+    assert rs.quantiles(db, qs) == [keys[int(q * (len(keys) - 1))] for q in qs]
+    assert rs.quantile(db, 0.5) == keys[(len(keys) - 1) // 2]
+    assert list(rs.iter_by_rank(db, 100, 2600, batch_size=1000)) == keys[100:2600]
+    assert list(rs.iter_by_rank(db.create_transaction(), len(keys) - 10)) == keys[-10:]
+    assert list(rs.iter_by_rank(db, len(keys))) == []
+
+def bulkLoadFailureTest(db, rs, n=10000):
+    size = rs.size(db)
+    keys = sorted(set(os.urandom(8) for _ in range(n))) + ["\x00"]
+    try:
+        rs.bulk_load(db, keys, batch_bytes=10000)
+    except Exception:
+        pass
+    else:
+        assert False, "bulk_load accepted keys out of order"
+    assert rs.size(db) == size
+    # No rows are left behind except those of the live load
+    loads = rs.subspace['B']
+    live = db[rs._location.key()]
+    if live == None:
+        assert list(db.get_range(loads.range().start, loads.range().stop, limit=1)) == []
+    else:
+        kept = loads[fdb.tuple.unpack(live)[0]].range()
+        assert list(db.get_range(loads.range().start, kept.start, limit=1)) == []
+        assert list(db.get_range(kept.stop, loads.range().stop, limit=1)) == []
+
+class _RoundTripCounter(RankedSet):
+    """ Records the levels read in each round trip. """
+
+    def __init__(self, db, subspace, *args):
+        self.round_trips = []
+        RankedSet.__init__(self, db, subspace, *args)
+
+    def _wait(self, values, ranges):
+        self.round_trips.append(sorted(set(level for level, _ in ranges)))
+        return RankedSet._wait(self, values, ranges)
+
+def roundTripTest(db, rs, n=100):
+    counter = _RoundTripCounter(db, rs.subspace)
+    size = counter.size(db)
+    ranks = random.sample(range(size), n)
+    keys = counter.get_nth_many(db, ranks)
+    # Each level below the cached ones is read in a single round trip
+    uncached = [[level] for level in range(counter._levels - counter._cache_levels - 1, -1, -1)]
+    counter.round_trips = []
+    assert counter.get_nth_many(db, ranks) == keys
+    assert counter.round_trips == uncached, counter.round_trips
+    counter.round_trips = []
+    assert counter.rank_many(db, keys) == ranks
+    assert counter.round_trips == uncached, counter.round_trips
+
+# Measures the round trips and latency of rank() and get_nth() with no levels
+# cached and with the default cache. Without the cache and the reads issued
+# together, rank() read the key and then each level in turn, taking one round
+# trip more than there are levels.
+def roundTripBenchmark(db, subspace, n=100000, lookups=100):
+    del db[subspace.range()]
+    keys = sorted(set(os.urandom(8) for _ in range(n)))
+    RankedSet(db, subspace).bulk_load(db, keys)
+    for cache_levels in (0, 2):
+        counter = _RoundTripCounter(db, subspace, None, None, cache_levels)
+        # Fill the cache
+        counter.rank(db, keys[0])
+        for name, op, args in (('rank', counter.rank, random.sample(keys, lookups)),
+                               ('get_nth', counter.get_nth, random.sample(range(len(keys)), lookups))):
+            counter.round_trips = []
+            start = time.time()
+            for a in args:
+                op(db, a)
+            elapsed = time.time() - start
+            print "%d levels, cache_levels=%d: %s took %.1f round trips, %.2f ms" % (
+                counter._levels, cache_levels, name,
+                float(len(counter.round_trips)) / lookups, elapsed * 1000 / lookups)
+
+def _insertWorker(db, rs, n, counters, lock):
+    for _ in range(n):
+        key = os.urandom(8)
+        tr = db.create_transaction()
+        while 1:
+            try:
+                rs.insert(tr, key)
+                tr.commit().wait()
+                break
+            except fdb.FDBError as e:
+                if e.code == 1020:
+                    with lock:
+                        counters['conflicts'] += 1
+                tr.on_error(e.code).wait()
+
+# Measures insert throughput with increasing numbers of concurrent writers, in
+# both modes.
+def insertBenchmark(db, subspace, writerCounts=(1, 2, 4, 8, 16), n=200):
+    for low_conflict in (False, True):
+        for writers in writerCounts:
+            del db[subspace.range()]
+            rs = RankedSet(db, subspace, low_conflict=low_conflict)
+            counters = {'conflicts': 0}
+            lock = threading.Lock()
+            threads = [threading.Thread(target=_insertWorker, args=(db, rs, n, counters, lock))
+                       for i in range(writers)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            assert rs.size(db) == writers * n
+            print "low_conflict=%s writers=%d: %.0f inserts/s, %d conflicts" % (
+                low_conflict, writers, writers * n / elapsed, counters['conflicts'])
+
 if __name__ == "__main__":
     db = fdb.open()
     rs_location = fdb.directory.create_or_open(db, ('rstest',))
@@ -268,4 +948,20 @@ if __name__ == "__main__":
     for t in threads:
         t.join()
 
+    bulkLoadTest(db, rs)
+    bulkLoadFailureTest(db, rs)
+    roundTripTest(db, rs)
+    rankedSetTest(db, rs)
+
+    rs = RankedSet(db, rs_location, low_conflict=True)
+    threads = [threading.Thread(target=rankedSetTest, args=(db, rs))
+               for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    roundTripBenchmark(db, fdb.directory.create_or_open(db, ('rsbench',)))
+    insertBenchmark(db, fdb.directory.create_or_open(db, ('rsbench',)))
+
     print "test finished"
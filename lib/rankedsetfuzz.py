@@ -0,0 +1,266 @@
+"""FoundationDB RankedSet Fuzzer.
+
+Runs long random sequences of operations against a RankedSet and against an
+in-memory sorted list of the same keys, and checks that they agree.
+
+Each step inserts or erases a key drawn from a configurable distribution, or
+looks one up by rank, key or range. After each step the set's size is checked,
+and a random rank is checked with both get_nth() and rank(). A mismatch raises
+an exception naming the seed and step, so that the sequence can be replayed.
+
+The latency of every operation is recorded, together with the round trips
+taken by its reads and the number of rows read at each level of the set, so
+that changes to the structure's parameters can be measured as well as
+checked. Each run's result is written as one line of JSON.
+"""
+
+import bisect
+import fractions
+import json
+import random
+import struct
+import sys
+import time
+
+import fdb
+
+import rankedset
+from queuebench import _percentile
+
+fdb.api_version(200)
+
+#################
+# Distributions #
+#################
+
+# Keys are fixed width big-endian integers, so that their order is numeric.
+def _key(i):
+    return struct.pack('>Q', i)
+
+class _Keys(object):
+    """Draws keys from one of several distributions over key_space integers."""
+
+    def __init__(self, rand, distribution, key_space):
+        self.rand = rand
+        self.distribution = distribution
+        self.key_space = key_space
+        self._next = 0
+        # Spreads the popular zipf ranks over the key space, rather than
+        # leaving them together at its start. Any multiplier coprime with
+        # key_space maps the ranks to keys one to one.
+        self._stride = 1
+        if key_space > 1:
+            self._stride = rand.randrange(1, key_space)
+            while fractions.gcd(self._stride, key_space) != 1:
+                self._stride = rand.randrange(1, key_space)
+
+    def next(self):
+        if self.distribution == 'uniform':
+            i = self.rand.randrange(self.key_space)
+        elif self.distribution == 'zipf':
+            # A few keys are drawn much more often than the rest: the rank
+            # r < key_space is drawn with probability about proportional to
+            # 1/(r+1), and mapped to its key.
+            r = int(self.key_space ** self.rand.random()) - 1
+            i = r * self._stride
+        elif self.distribution == 'sequential':
+            # Each key is appended after the greatest key
+            self._next += 1
+            i = self._next
+        elif self.distribution == 'clustered':
+            # Keys fall in a few narrow bands of the key space
+            band = self.rand.randrange(8) * (self.key_space // 8)
+            i = band + self.rand.randrange(max(1, self.key_space // 1000))
+        else:
+            raise Exception("Unknown key distribution: %s" % self.distribution)
+        return _key(i % self.key_space)
+
+###########
+# Fuzzing #
+###########
+
+class _CountingRankedSet(rankedset.RankedSet):
+    """Counts the round trips taken by lookups and the rows read at each level."""
+
+    def __init__(self, db, *args):
+        self.rows_read = {}
+        self.round_trips = 0
+        rankedset.RankedSet.__init__(self, db, *args)
+
+    def _wait(self, values, ranges):
+        results = rankedset.RankedSet._wait(self, values, ranges)
+        self.round_trips += 1
+        for (level, _), rows in zip(ranges, results):
+            self.rows_read[level] = self.rows_read.get(level, 0) + len(rows)
+        return results
+
+    def _get_previous_node(self, tr, level, key, snapshot=False):
+        self.rows_read[level] = self.rows_read.get(level, 0) + 1
+        return rankedset.RankedSet._get_previous_node(self, tr, level, key, snapshot)
+
+class _Stats(object):
+    def __init__(self):
+        self.latencies = {}
+        self.rows = {}
+        self.round_trips = {}
+
+    def record(self, op, latency, rows_read, round_trips):
+        self.latencies.setdefault(op, []).append(latency)
+        self.round_trips[op] = self.round_trips.get(op, 0) + round_trips
+        total = self.rows.setdefault(op, {})
+        for level, rows in rows_read.items():
+            total[level] = total.get(level, 0) + rows
+
+    def summary(self):
+        result = {}
+        for op, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            result[op] = {
+                'count': len(latencies),
+                'latencyP50': _percentile(latencies, 0.5),
+                'latencyP99': _percentile(latencies, 0.99),
+                'latencyMax': _percentile(latencies, 1.0),
+                'roundTrips': float(self.round_trips[op]) / len(latencies),
+                'rowsPerLevel': dict((str(level), float(rows) / len(latencies))
+                                     for level, rows in sorted(self.rows[op].items())),
+            }
+        return result
+
+def _timed(stats, rs, op, func, *args):
+    rs.rows_read = {}
+    rs.round_trips = 0
+    start = time.time()
+    result = func(*args)
+    stats.record(op, time.time() - start, rs.rows_read, rs.round_trips)
+    return result
+
+def _check(condition, seed, step, message):
+    if not condition:
+        raise Exception("Mismatch at step %d of seed %d: %s" % (step, seed, message))
+
+def run_fuzz(db, steps=10000, initial_size=1000, distribution='uniform', key_space=1000000,
+             seed=None, levels=None, fan_pow=None, cache_levels=2, low_conflict=False):
+    """
+    Run one sequence of steps random operations and return its result as a
+    dictionary.
+
+    Keys are drawn from the distribution, which is one of 'uniform', 'zipf',
+    'sequential' or 'clustered', over key_space possible keys. The set is
+    first bulk loaded with initial_size distinct keys. A distribution too
+    narrow to give that many is drawn from 10 * initial_size times, and the
+    set is loaded with the distinct keys drawn.
+
+    levels, fan_pow, cache_levels and low_conflict are passed to the
+    RankedSet.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rand = random.Random(seed)
+    keys = _Keys(rand, distribution, key_space)
+
+    subspace = fdb.directory.create_or_open(db, ('tests','rankedsetfuzz'))
+    del db[subspace.range()]
+    rs = _CountingRankedSet(db, subspace, levels, fan_pow, cache_levels, low_conflict)
+
+    initial = set()
+    for _ in range(10 * initial_size):
+        if len(initial) >= initial_size:
+            break
+        initial.add(keys.next())
+    reference = sorted(initial)
+    start = time.time()
+    rs.bulk_load(db, reference)
+    loadTime = time.time() - start
+
+    stats = _Stats()
+    start = time.time()
+    for step in range(steps):
+        op = rand.choice(('insert', 'insert', 'erase', 'rank', 'get_nth', 'count_range'))
+        key = keys.next()
+        i = bisect.bisect_left(reference, key)
+        present = i < len(reference) and reference[i] == key
+
+        if op == 'insert':
+            _timed(stats, rs, op, rs.insert, db, key)
+            if not present:
+                reference.insert(i, key)
+        elif op == 'erase':
+            if reference and not present:
+                # Mostly erase keys that are in the set
+                key = reference[rand.randrange(len(reference))]
+                i = bisect.bisect_left(reference, key)
+                present = True
+            _timed(stats, rs, op, rs.erase, db, key)
+            if present:
+                del reference[i]
+        elif op == 'rank':
+            r = _timed(stats, rs, op, rs.rank, db, key)
+            _check(r == (i if present else None), seed, step, "rank(%r) is %r" % (key, r))
+        elif op == 'get_nth':
+            r = rand.randrange(len(reference) + 1)
+            k = _timed(stats, rs, op, rs.get_nth, db, r)
+            expected = reference[r] if r < len(reference) else None
+            _check(k == expected, seed, step, "get_nth(%d) is %r, not %r" % (r, k, expected))
+        elif op == 'count_range':
+            end = keys.next()
+            if end < key:
+                key, end = end, key
+            c = _timed(stats, rs, op, rs.count_range, db, key, end)
+            expected = bisect.bisect_left(reference, end) - bisect.bisect_left(reference, key)
+            _check(c == expected, seed, step, "count_range(%r, %r) is %d, not %d" % (key, end, c, expected))
+
+        size = rs.size(db)
+        _check(size == len(reference), seed, step, "size is %d, not %d" % (size, len(reference)))
+        if reference:
+            r = rand.randrange(len(reference))
+            k = rs.get_nth(db, r)
+            _check(k == reference[r], seed, step, "get_nth(%d) is %r, not %r" % (r, k, reference[r]))
+            r2 = rs.rank(db, k)
+            _check(r2 == r, seed, step, "rank(%r) is %r, not %d" % (k, r2, r))
+    elapsed = time.time() - start
+
+    _check(list(rs.iter_by_rank(db, 0)) == reference, seed, steps, "final contents differ")
+
+    return {
+        'time': start,
+        'seed': seed,
+        'steps': steps,
+        'distribution': distribution,
+        'keySpace': key_space,
+        'initialSize': initial_size,
+        'finalSize': len(reference),
+        'levels': rs._levels,
+        'fanPow': rs._fan_pow,
+        'cacheLevels': rs._cache_levels,
+        'lowConflict': low_conflict,
+        'loadTime': loadTime,
+        'stepsPerSecond': steps / elapsed,
+        'ops': stats.summary(),
+    }
+
+# caution: modifies the database!
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fuzz and measure the RankedSet layer.')
+    parser.add_argument('--steps', type=int, default=10000)
+    parser.add_argument('--initial-size', type=int, default=1000)
+    parser.add_argument('--distribution', default='uniform',
+                        choices=('uniform', 'zipf', 'sequential', 'clustered'))
+    parser.add_argument('--key-space', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--levels', type=int, default=None)
+    parser.add_argument('--fan-pow', type=int, default=None)
+    parser.add_argument('--cache-levels', type=int, default=2)
+    parser.add_argument('--low-conflict', action='store_true')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--output', default=None, help='file to append results to')
+    args = parser.parse_args()
+
+    db = fdb.open()
+    out = open(args.output, 'a') if args.output else sys.stdout
+    for run in range(args.runs):
+        result = run_fuzz(db, args.steps, args.initial_size, args.distribution, args.key_space,
+                          args.seed, args.levels, args.fan_pow, args.cache_levels, args.low_conflict)
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
@@ -6,11 +6,20 @@ Scored sets support an extended form of ranked set similar to the Redis "sorted
 set" data type. Scored sets are collections of items (of any type handled by
 the tuple layer) associated with an integer score. Items can be present at most
 once in the collection, but multiple items can have the same score. Items are
-sorted and ranked by their scores.
+sorted and ranked by their scores, and items with the same score by the items
+themselves.
 
-The RankedSet layer is used to provide fast operations for rankings. In
+The RankedSet layer is used to provide fast operations for rankings. It holds
+every (score, item) pair, so the position of an item among all items, the
+number of items in a range of scores, and the item at a given position are all
+found in O(log n) round trips, however many items share a score. In
 addition to basic operations for insertion, deletion, and updating of items,
 ranges of items can be quickly retrieved by score or by rank.
+
+Ranks are positions among all items, not among distinct scores, so
+get_rank_by_score() returns the rank of the first item with a score. A set
+written when only distinct scores were ranked must be upgraded once with
+upgrade() before its ranks are used.
 """
 
 import os
@@ -31,9 +40,24 @@ class ScoredSet:
 
     def __init__(self, db, subspace):
         self.subspace = subspace
-        self._rs = rankedset.RankedSet(db, self.subspace['R'])
+        # Packed (score, item) pairs
+        self._rs = rankedset.RankedSet(db, self.subspace['T'])
         self._score = self.subspace['S']
         self._items = self.subspace['I']
+        # Holds the items key before which upgrade() has ranked every item
+        self._upgraded = self.subspace['U']
+
+    def upgrade(self, db, batch_size=100):
+        ''' Rank the items of a set written when only distinct scores were
+        ranked.
+
+        Items are ranked in transactions of batch_size items. Progress is kept
+        in the database, so an interrupted upgrade resumes where it stopped,
+        and upgrading a set that is already upgraded only reads one key.
+        Cannot be composed with other functions in a single transaction.
+        '''
+        while not self._upgrade(db, batch_size):
+            pass
 
     @fdb.transactional
     def insert(self, tr, item, score):
@@ -42,10 +66,9 @@ class ScoredSet:
         s = tr[self._score[item]]
         if s.present():
             old_score = self._decode_score(s)
-            if self._no_other(tr, item, old_score):
-                self._rs.erase(tr, old_score)
+            self._rs.erase(tr, self._rank_key(old_score, item))
             del tr[self._items[old_score][item]]
-        self._rs.insert(tr, score)
+        self._rs.insert(tr, self._rank_key(score, item))
         tr[self._score[item]] = self._encode_score(score)
         tr[self._items[score][item]] = ''
         return old_score
@@ -61,10 +84,9 @@ class ScoredSet:
             score = old_score + increment
         except:
             raise Exception('increment requires integer scores')
-        if self._no_other(tr, item, old_score):
-            self._rs.erase(tr, old_score)
+        self._rs.erase(tr, self._rank_key(old_score, item))
         del tr[self._items[old_score][item]]
-        self._rs.insert(tr, score)
+        self._rs.insert(tr, self._rank_key(score, item))
         tr[self._score[item]] = self._encode_score(score)
         tr[self._items[score][item]] = ''
         return old_score
@@ -76,18 +98,25 @@ class ScoredSet:
         if not s.present():
             return None
         score = self._decode_score(s)
-        if self._no_other(tr, item, score):
-            self._rs.erase(tr, score)
+        self._rs.erase(tr, self._rank_key(score, item))
         del tr[self._items[score][item]]
         del tr[self._score[item]]
         return score
 
     @fdb.transactional
     def delete_by_rank(self, tr, start_rank, stop_rank):
-        ''' Delete all items within the range [start_rank, stop_rank). '''
-        start_score, stop_score = self._rank_range_to_scores(tr, start_rank,
-                                                                 stop_rank)
-        return self.delete_by_score(tr, start_score, stop_score)
+        ''' Delete all items within the range [start_rank, stop_rank).
+
+        Returns the list of distinct scores of the deleted items.
+        '''
+        scores = []
+        for score, item in self._range_by_rank(tr, start_rank, stop_rank):
+            self._rs.erase(tr, self._rank_key(score, item))
+            del tr[self._items[score][item]]
+            del tr[self._score[item]]
+            if not scores or scores[-1] != score:
+                scores.append(score)
+        return scores
 
     @fdb.transactional
     def delete_by_score(self, tr, start_score, stop_score):
@@ -97,9 +126,8 @@ class ScoredSet:
                                  self._items[stop_score]):
             score, item = self._items.unpack(k)
             del tr[self._score[item]]
-            if score not in erased:
-                self._rs.erase(tr, score)
-                erased[score] = ''
+            self._rs.erase(tr, self._rank_key(score, item))
+            erased[score] = ''
         del tr[self._items[start_score]:self._items[stop_score]]
         return list(erased)
 
@@ -117,18 +145,28 @@ class ScoredSet:
             return None
         return self._decode_score(s)
 
+    @fdb.transactional
+    def get_nth(self, tr, rank):
+        ''' Return the item with given rank, or None if out of bounds. '''
+        if rank < 0:
+            return None
+        key = self._rs.get_nth(tr, rank)
+        if key is None:
+            return None
+        return fdb.tuple.unpack(key)[1]
+
     @fdb.transactional
     def get_items_by_rank(self, tr, rank):
-        ''' Return list of items with given rank. '''
-        score = self._rs.get_nth(tr, rank)
-        return self.get_items(tr, score)
+        ''' Return list of items with the same score as the item with given rank. '''
+        key = self._rs.get_nth(tr, rank)
+        if key is None:
+            return []
+        return self.get_items(tr, fdb.tuple.unpack(key)[0])
 
     @fdb.transactional
     def get_range_by_rank(self, tr, start_rank, stop_rank):
         ''' Return list of items in the range [start_rank, stop_rank). '''
-        start_score, stop_score = self._rank_range_to_scores(tr, start_rank,
-                                                                 stop_rank)
-        return self.get_range_by_score(tr, start_score, stop_score)
+        return [item for _, item in self._range_by_rank(tr, start_rank, stop_rank)]
 
     @fdb.transactional
     def get_range_by_score(self, tr, start_score, stop_score, reverse=False):
@@ -143,34 +181,44 @@ class ScoredSet:
 
     @fdb.transactional
     def get_rank(self, tr, item):
-        ''' Return the rank of a item. '''
+        ''' Return the position of item among all items, or None if not present. '''
         score = self.get_score(tr, item)
-        return self._rs.rank(tr, score)
+        if score is None:
+            return None
+        return self._rs.rank(tr, self._rank_key(score, item))
 
     @fdb.transactional
     def get_rank_by_score(self, tr, score):
-        ''' Return the rank of a given score. '''
-        return self._rs.rank(tr, score)
+        ''' Return the rank of the first item with a given score, or None if
+        no item has that score.
+        '''
+        for k, _ in tr.get_range(self._items[score].range().start,
+                                 self._items[score].range().stop, limit=1):
+            return self._rs.rank(tr, fdb.tuple.pack(self._items.unpack(k)))
+        return None
 
     @fdb.transactional
     def get_successors(self, tr, item):
-        ''' Return list of immediate successors of item by rank. '''
-        rank = self.get_rank(tr, item)
-        successor_score = self._rs.get_nth(tr, rank + 1)
-        if successor_score:
-            return self.get_items(tr, successor_score)
-        else:
+        ''' Return list of items with the next higher score than item. '''
+        score = self.get_score(tr, item)
+        if score is None:
             return []
+        for k, _ in tr.get_range(self._items[score].range().stop,
+                                 self._items.range().stop, limit=1):
+            return self.get_items(tr, self._items.unpack(k)[0])
+        return []
 
     @fdb.transactional
     def get_predecessors(self, tr, item):
-        ''' Return list of immediate predecessors of item by rank. '''
-        rank = self.get_rank(tr, item)
-        predecessor_score = self._rs.get_nth(tr, rank - 1)
-        if predecessor_score:
-            return self.get_items(tr, predecessor_score)
-        else:
+        ''' Return list of items with the next lower score than item. '''
+        score = self.get_score(tr, item)
+        if score is None:
             return []
+        for k, _ in tr.get_range(self._items.range().start,
+                                 self._items[score].range().start,
+                                 limit=1, reverse=True):
+            return self.get_items(tr, self._items.unpack(k)[0])
+        return []
 
     @fdb.transactional
     def get_max_rank(self, tr):
@@ -190,11 +238,8 @@ class ScoredSet:
     @fdb.transactional
     def count_by_score(self, tr, start_score, stop_score):
         ''' Return number of items in the range [start_score, stop_score). '''
-        count = 0
-        for _ in tr.get_range(self._items[start_score],
-                              self._items[stop_score]):
-            count += 1
-        return count
+        return self._rs.count_range(tr, fdb.tuple.pack((start_score,)),
+                                    fdb.tuple.pack((stop_score,)))
 
     @fdb.transactional
     def iterate(self, tr):
@@ -210,28 +255,46 @@ class ScoredSet:
     def _decode_score(self, v):
         return struct.unpack('<q', str(v))[0]
 
-    @fdb.transactional
-    def _no_other(self, tr, item, score):
-        ''' Return True if there is no other element than item with score. '''
-        r = self._items[score].range()
-        for k, _ in tr.get_range(r.start, r.stop, limit=2):
-            s, i = self._items.unpack(k)
-            if i != item:
-                return False
-        return True
+    # Items are ranked by (score, item), the same order as the items subspace
+    def _rank_key(self, score, item):
+        return fdb.tuple.pack((score, item))
 
     @fdb.transactional
-    def _rank_range_to_scores(self, tr, start_rank, stop_rank):
-        ''' Return scores corresponding to range [start_rank, stop_rank).
+    def _range_by_rank(self, tr, start_rank, stop_rank):
+        ''' Return (score, item) pairs in the range [start_rank, stop_rank).
         '''
         if start_rank < 0:
             raise Exception('rank must be nonnegative')
-        start_score = self._rs.get_nth(tr, start_rank)
-        if stop_rank > self._rs.size(tr) - 1:
-            stop_score = sys.maxint
-        else:
-            stop_score = self._rs.get_nth(tr, stop_rank)
-        return start_score, stop_score
+        if stop_rank <= start_rank:
+            return []
+        key = self._rs.get_nth(tr, start_rank)
+        if key is None:
+            return []
+        return [self._items.unpack(k)
+                for k, _ in tr.get_range(self._items.pack(fdb.tuple.unpack(key)),
+                                         self._items.range().stop,
+                                         limit=stop_rank - start_rank)]
+
+    @fdb.transactional
+    def _upgrade(self, tr, batch_size):
+        ''' Rank the next batch_size items for upgrade(), and return True once
+        every item is ranked.
+        '''
+        end = self._items.range().stop
+        begin = tr[self._upgraded.key()]
+        if begin == end:
+            return True
+        begin = self._items.range().start if begin == None else str(begin)
+        rows = list(tr.get_range(begin, end, limit=batch_size))
+        for k, _ in rows:
+            self._rs.insert(tr, fdb.tuple.pack(self._items.unpack(k)))
+        if len(rows) < batch_size:
+            # The ranked set of distinct scores
+            del tr[self.subspace['R'].range()]
+            tr[self._upgraded.key()] = end
+            return True
+        tr[self._upgraded.key()] = rows[-1].key + '\x00'
+        return False
 
 ###########
 # Testing #
@@ -292,13 +355,13 @@ def scored_set_op(tr, ss):
         if max_rank is None:
             return
         r = random.randint(0, max_rank)
-        items = ss.get_items_by_rank(tr, r)
-        i = random.choice(items)
+        i = ss.get_nth(tr, r)
         r2 = ss.get_rank(tr, i)
+        items = ss.get_items_by_rank(tr, r)
         with excl:
-            if not (r == r2):
-                print [i], r, r2
-        assert r == r2
+            if not (r == r2 and i in items):
+                print [i], r, r2, items
+        assert r == r2 and i in items
 
     if op == 14:
         max_rank = ss.get_max_rank(tr)
@@ -307,14 +370,15 @@ def scored_set_op(tr, ss):
         ranks = sorted([random.randint(0, max_rank), 
                         random.randint(0, max_rank)])
         items = ss.get_range_by_rank(tr, ranks[0], ranks[1])
+        assert len(items) == ranks[1] - ranks[0]
         if not items:
             return
         i = random.choice(items)
         r = ss.get_rank(tr, i)
         with excl:
-            if not (ranks[0] <= r <= ranks[1]):
+            if not (ranks[0] + items.index(i) == r):
                 print [i], ranks[0], r, ranks[1]
-        assert ranks[0] <= r <= ranks[1]
+        assert ranks[0] + items.index(i) == r
 
     if op == 15:
         scores = sorted([score, random.randint(0, 100)])
@@ -336,12 +400,13 @@ def scored_set_op(tr, ss):
         if not items:
             return
         item2 = random.choice(items)
-        r = ss.get_rank(tr, item)
-        r2 = ss.get_rank(tr, item2)
+        s = ss.get_score(tr, item)
+        s2 = ss.get_score(tr, item2)
+        between = ss.count_by_score(tr, s + 1, s2)
         with excl:
-            if not (r2 == r + 1):
-                print r2, r
-        assert r2 == r + 1
+            if not (s2 > s and between == 0):
+                print s2, s, between
+        assert s2 > s and between == 0
 
     if op == 17:
         r = ss.get_rank(tr, item)
@@ -351,19 +416,20 @@ def scored_set_op(tr, ss):
         if not items:
             return
         item2 = random.choice(items)
-        r = ss.get_rank(tr, item)
-        r2 = ss.get_rank(tr, item2)
+        s = ss.get_score(tr, item)
+        s2 = ss.get_score(tr, item2)
+        between = ss.count_by_score(tr, s2 + 1, s)
         with excl:
-            if not (r2 == r - 1):
-                print r2, r
-        assert r2 == r - 1
+            if not (s2 < s and between == 0):
+                print s2, s, between
+        assert s2 < s and between == 0
 
     if op == 18:
         max_score = ss.get_max_score(tr)
         if max_score is None:
             return
-        items = ss.get_items(tr, max_score)
-        item = random.choice(items)
+        # The last of the items with the maximum score has the maximum rank
+        item = ss.get_items(tr, max_score)[-1]
         max_rank = ss.get_max_rank(tr)
         r = ss.get_rank(tr, item)
         with excl:
@@ -393,6 +459,27 @@ def random_test(db, ss):
         scored_set_op(db, ss)
 
 
+@fdb.transactional
+def items_by_rank(tr, ss):
+    return [item for item, _ in sorted(ss.iterate(tr), key=lambda p: (p[1], p[0]))]
+
+def upgrade_test(db, subspace):
+    clear_subspace(db, subspace)
+    ss = ScoredSet(db, subspace)
+    for i in range(250):
+        ss.insert(db, i, random.randint(0, 10))
+    expected = items_by_rank(db, ss)
+    # Forget the ranking, as if the set predated it, and rank one batch
+    ss._rs.clear_all(db)
+    assert not ss._upgrade(db, 100)
+    # The upgrade resumes after the first batch
+    ss = ScoredSet(db, subspace)
+    ss.upgrade(db)
+    assert ss._upgrade(db, 100)
+    assert ss.get_range_by_rank(db, 0, len(expected)) == expected
+    assert [ss.get_rank(db, item) for item in expected] == range(len(expected))
+
+
 @fdb.transactional
 def clear_subspace(tr, subspace):
     del tr[subspace.range()]
@@ -410,4 +497,6 @@ if __name__ == "__main__":
     for t in threads:
         t.join()
 
+    upgrade_test(db, scored_set)
+
     print "test finished"